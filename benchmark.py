@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+################################################################################
+# Configuration
+#
+
+# System modules
+import argparse    # python-argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import logging
+import tempfile
+import time
+
+# Application
+import latitude
+import simulation
+
+# Definitions
+HOME              = (50.880, 4.700)   # Where the synthetic user lives
+WORK              = (50.850, 4.350)   # Where the synthetic user works
+TOWN              = (50.879, 4.701)   # Where the synthetic user goes shopping
+GPS_PERIOD        = 5      # How often the traces contain a GPS fix (seconds)
+GPS_NOISE         = 5      # Standard deviation of the noise on GPS fixes (meters)
+GPS_ACCURACY      = 10     # Accuracy the GPS fixes claim (meters)
+WIFI_ACCURACY     = 40     # Accuracy Skyhook gives for a known access point (meters)
+CELL_ACCURACY     = 1500   # Accuracy of a cell fix (meters)
+DRIVING_SPEED     = 80     # How fast the synthetic user drives (km/h)
+WALKING_SPEED     = 5      # How fast the synthetic user walks (km/h)
+FLAP_MIN          = 30     # Shortest time connectivity stays the same when flapping (seconds)
+FLAP_MAX          = 120    # Longest time connectivity stays the same when flapping (seconds)
+
+# Results are a JSON document with, per scenario:
+#   duration:           simulated time (seconds)
+#   fixes:              how many fixes a lookup delivered
+#   time_to_fix:        p50 and p99 of the time between starting a lookup
+#                       and its first acceptable fix (seconds)
+#   update_time:        p50 and p99 of the time an update takes (seconds)
+#   updates:            how many updates finished
+#   http_requests:      Skyhook and Latitude requests
+#   uploads_per_update: Latitude requests per finished update
+#   upload_retries:     Latitude batches sent again right away
+#   bytes_sent:         request payloads
+#   gps_seconds:        how long the GPS has been running
+#   radio_seconds:      how long connections we brought up stayed up
+#   longest_callback:   wall-clock time of the slowest main loop callback
+#                       (seconds), and which one it was
+#   peak_memory:        maximal resident set size (KiB)
+#   runtime:            wall-clock time of the replay (seconds)
+
+
+#
+# Scenarios
+#
+
+class Trace:
+    # Builds a trace of a synthetic day
+
+    # Constructor
+    def __init__(self, seed):
+        self.records = []
+        self.random = random.Random(seed)
+
+    # Actions
+    def add(self, t, kind, **fields):
+        fields["t"] = t
+        fields["type"] = kind
+        self.records.append(fields)
+    def place(self, t, position, bssid, cell):
+        # Arrive at a place with a known access point and cell
+        self.add(t, "scan", accesspoints=[{"bssid": bssid, "rssi": -60}], lat=position[0], lng=position[1], acc=WIFI_ACCURACY)
+        self.add(t, "cell", cell=cell, lat=position[0], lng=position[1], acc=CELL_ACCURACY)
+    def leave(self, t):
+        self.add(t, "scan", accesspoints=[])
+    def gps(self, start, end, origin, destination, speed):
+        # Fixes along a straight line, at the given speed (km/h) until we get there
+        distance = latitude.distance(origin[0], origin[1], destination[0], destination[1])
+        travel = distance / (speed / 3.6) if speed > 0 else 0
+        for t in range(int(start), int(end), GPS_PERIOD):
+            progress = min((t - start) / travel, 1.0) if travel > 0 else 1.0
+            moving = progress < 1.0
+            lat = origin[0] + progress * (destination[0] - origin[0])
+            lng = origin[1] + progress * (destination[1] - origin[1])
+            noise = GPS_NOISE / 111320.0
+            self.add(t, "gps", lat=lat + self.random.gauss(0, noise),
+                lng=lng + self.random.gauss(0, noise / math.cos(math.radians(lat))),
+                acc=GPS_ACCURACY, speed=speed if moving else 0, head=0)
+        return start + travel
+
+def stationary(trace):
+    # A day at home, on WIFI
+    trace.place(0, HOME, "00:11:22:33:44:55", [206, 10, 1234, 5678])
+    trace.add(0, "connection", connected=True, bearer="WLAN_INFRA")
+    trace.gps(0, 86400, HOME, HOME, 0)
+
+def commute(trace):
+    # Home, a drive with an intermediate cell, and the office
+    trace.place(0, HOME, "00:11:22:33:44:55", [206, 10, 1234, 5678])
+    trace.add(0, "connection", connected=True, bearer="WLAN_INFRA")
+    trace.gps(0, 1800, HOME, HOME, 0)
+    trace.add(1800, "connection", connected=False)
+    trace.leave(1800)
+    arrival = trace.gps(1800, 7200, HOME, WORK, DRIVING_SPEED)
+    trace.add((1800 + arrival) / 2, "cell", cell=[206, 10, 1235, 9999],
+        lat=(HOME[0] + WORK[0]) / 2, lng=(HOME[1] + WORK[1]) / 2, acc=CELL_ACCURACY)
+    trace.place(arrival, WORK, "66:77:88:99:aa:bb", [206, 10, 1236, 4321])
+    trace.add(arrival, "connection", connected=True, bearer="WLAN_INFRA")
+
+def tunnel(trace):
+    # A drive which loses both the sky and the network for ten minutes
+    trace.place(0, HOME, "00:11:22:33:44:55", [206, 10, 1234, 5678])
+    trace.leave(60)
+    middle = ((HOME[0] + WORK[0]) / 2, (HOME[1] + WORK[1]) / 2)
+    entrance = trace.gps(60, 1200, HOME, middle, DRIVING_SPEED)
+    trace.add(entrance, "coverage", available=False)
+    trace.add(entrance + 600, "coverage", available=True)
+    trace.gps(entrance + 600, entrance + 2400, middle, WORK, DRIVING_SPEED)
+
+def flapping(trace):
+    # Strolling through town on a network that keeps coming and going
+    trace.place(0, TOWN, "00:11:22:33:44:55", [206, 10, 1234, 5678])
+    trace.leave(60)
+    trace.gps(0, 7200, TOWN, HOME, WALKING_SPEED)
+    t, available = 0, True
+    while t < 7200:
+        trace.add(t, "coverage", available=available)
+        if available:
+            trace.add(t, "connection", connected=True, bearer="GPRS")
+        t += trace.random.randint(FLAP_MIN, FLAP_MAX)
+        available = not available
+
+scenarios = {
+    "stationary": stationary,
+    "commute": commute,
+    "tunnel": tunnel,
+    "flapping": flapping,
+}
+
+
+#
+# Auxiliary
+#
+
+class Recorder(latitude.Metrics):
+    # Also keeps the individual observations, for percentiles
+
+    # Constructor
+    def __init__(self):
+        latitude.Metrics.__init__(self)
+        self.samples = {}
+
+    # Actions
+    def observe(self, name, value):
+        latitude.Metrics.observe(self, name, value)
+        self.samples.setdefault(name, []).append(value)
+    def select(self, prefix, suffix):
+        values = []
+        for name, samples in self.samples.items():
+            if name.startswith(prefix) and name.endswith(suffix):
+                values.extend(samples)
+        return values
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+def replay(name, seed, extra):
+    # Run a scenario in this process, and measure it
+    trace = Trace(seed)
+    scenarios[name](trace)
+    trace.records.sort(key=lambda record: record["t"])
+    os.chdir(tempfile.mkdtemp(prefix='latitude-'))
+
+    recorder = latitude.metrics = Recorder()
+    backend = simulation.SimulatedBackend(trace.records)
+    latitude.init(latitude.parser.parse_args(extra), backend)
+    started = time.time()
+    backend.clock.run(simulation.START + backend.duration)
+    runtime = time.time() - started
+    backend.finish()
+
+    statistics = backend.statistics
+    fixes = recorder.select("fix.", ".seconds")
+    updates = recorder.samples.get("actor.update.seconds", [])
+    return {
+        "duration": backend.duration,
+        "fixes": len(fixes),
+        "time_to_fix": {"p50": percentile(fixes, 0.5), "p99": percentile(fixes, 0.99)},
+        "update_time": {"p50": percentile(updates, 0.5), "p99": percentile(updates, 0.99)},
+        "updates": len(updates),
+        "http_requests": statistics.skyhook_requests + statistics.upload_requests,
+        "uploads_per_update": statistics.upload_requests / float(max(len(updates), 1)),
+        "upload_retries": statistics.upload_retries,
+        "bytes_sent": statistics.bytes_sent,
+        "gps_seconds": statistics.gps_seconds,
+        "radio_seconds": statistics.connected_seconds,
+        "longest_callback": {"seconds": backend.clock.longest, "callback": backend.clock.culprit},
+        "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "runtime": runtime,
+    }
+
+def run(name, seed, extra):
+    # Each scenario gets a process of its own, for a clean state and memory peak
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--seed', str(seed), name, '--'] + extra
+    output = subprocess.check_output(command)
+    return json.loads(output)
+
+def revision():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=directory,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=""):
+    # Numeric results by dotted name
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(old, new):
+    # Show what changed between two runs
+    lines = []
+    old = flatten(old["scenarios"])
+    new = flatten(new["scenarios"])
+    for name in sorted(new):
+        if name not in old:
+            continue
+        before, after = old[name], new[name]
+        if before == after:
+            continue
+        change = "%+.1f%%" % ((after - before) * 100.0 / before) if before != 0 else "new"
+        lines.append("%-45s %12.3f -> %12.3f  %s" % (name, before, after, change))
+    return "\n".join(lines)
+
+
+#
+# Application handling
+#
+
+def main(args, extra):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format='%(levelname)-10s %(name)s: %(message)s')
+
+    if args.child:
+        print json.dumps(replay(args.scenario[0], args.seed, extra))
+        return
+
+    document = {
+        "revision": revision(),
+        "time": int(time.time()),
+        "arguments": extra,
+        "seed": args.seed,
+        "scenarios": {},
+    }
+    for name in args.scenario or sorted(scenarios):
+        document["scenarios"][name] = run(name, args.seed, extra)
+
+    output = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        stream = open(args.output, 'w')
+        stream.write(output + "\n")
+        stream.close()
+    else:
+        print output
+    if args.compare:
+        print >> sys.stderr, compare(json.load(open(args.compare)), document)
+
+
+parser = argparse.ArgumentParser(description='Replay synthetic scenarios against simulated hardware, and measure the updater.',
+                                 epilog='Arguments after -- are passed on to the updater.')
+parser.add_argument('scenario', help='which scenarios to run (defaults to all)', nargs='*', choices=[[]] + sorted(scenarios))
+parser.add_argument('--seed', help='seed for the noise in the scenarios', type=int, default=0)
+parser.add_argument('--output', '-o', help='where to write the results (defaults to standard output)')
+parser.add_argument('--compare', '-c', help='results of an earlier run to compare with')
+parser.add_argument('--verbose', '-v', help='print more information', action='store_true')
+parser.add_argument('--child', help=argparse.SUPPRESS, action='store_true')
+
+if __name__ == '__main__':
+    # The updater takes options with values, which we can't tell apart from scenarios
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--')+1:]
+    main(parser.parse_args(argv), extra)
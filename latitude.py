@@ -12,58 +12,399 @@ import os
 import sys
 import logging
 import signal
+import threading
+import Queue
+import traceback
+import struct
+import zlib
+import math
+import collections
+import array
+import copy
+import bisect
+import random
+import calendar
+import csv
 
 # WIFI scanning
 import subprocess
+import mmap
 
 # Skyhook
 import re
 import socket
 import httplib
 
-# Geolocation
-import location    # python-location
+# Device bindings (geolocation, network connectivity, device state),
+# imported by the DeviceBackend as they're only available on the device itself
 
-# Network connectivity
-import conic
-
-# Google Latitude
-import httplib2
+# Google Latitude (the client library is slow to import, so ServiceWrapper
+# only does so when it first needs it)
 import pickle
-from apiclient.discovery import build   # google-api-python-client
-from apiclient.oauth import FlowThreeLegged
-from apiclient.ext.authtools import run
-from apiclient.ext.file import Storage
-
-# Device wrapper
-import osso
 
 # Definitions
 UPDATE_AT_MOST    = 1      # NEVER update more than this (minutes) even when moving
 UPDATE_AT_LEAST   = 15     # NEVER update LESS than this (minutes) even when still (to avoid "stale points" in Latitude)
+UPDATE_DISTANCE   = 500    # How far we are allowed to move between updates (meters)
+UPDATE_STILL      = 50     # Moving less than this between fixes counts as standing still (meters)
+UPDATE_TURN       = 45     # Changing heading more than this counts as a turn (degrees)
+UPDATE_BACKOFF    = 2      # How fast the delay grows while standing still
+UPDATE_INACTIVE   = 5      # Don't update more often than this while the device is inactive (minutes)
+TRACK_TOLERANCE   = 25     # How far a point may lie off the simplified track before we keep it (meters)
 TIMEOUT_CONN      = 10     # How long we are allowed to wait for a connection
+UPLOAD_MIN_ENTRIES= 10     # How many queued entries justify bringing up a connection ourselves
+UPLOAD_MAX_AGE    = 15     # How old a queued entry may get before we bring up a connection ourselves (minutes)
 TIMEOUT_GPS       = 30     # How long we are allowed to wait for a GPS fix
 TIMEOUT_GSM       = 10     # How lone we are allowed to wait for a GSM fix
+TIMEOUT_UPDATE    = 2*TIMEOUT_CONN + TIMEOUT_GSM + TIMEOUT_GPS + 10  # How long a whole update is allowed to take
+WORKERS           = 2      # How many threads handle blocking I/O
+LOOP_BUDGET       = 200    # How long a callback may block the main loop (milliseconds)
 MIN_ACCURACY_GSM  = 2500   # The minimal accuracy of a cell fix to be accepted
 MIN_ACCURACY_GPS  = 150    # The minimal accuracy of a gps fix to be accepted
+FUSION_ACCURACY   = 50     # The fused accuracy at which we stop the GPS
+FUSION_NOISE      = 1      # How fast we expect the velocity to change (m/s^2)
+FUSION_VELOCITY   = 2      # The accuracy of a GPS velocity measurement (m/s)
+FUSION_RESET      = 600    # After how long the previous estimate is useless (seconds)
+FUSION_MIN_ACCURACY = 1    # No fix is more accurate than this, whatever it claims (meters)
+GPS_STANDBY_DISTANCE = 200 # How far we may move between fixes while the GPS is on standby (meters)
+GPS_STANDBY_INTERVAL = 120 # The longest interval between fixes while the GPS is on standby (seconds)
+GPS_STANDBY_MAX   = 20     # How long the GPS may stay on standby without being used (minutes)
+GPS_STILL_SPEED   = 1      # Moving slower than this counts as standing still (m/s)
+GPS_STILL_TIME    = 120    # How long we stand still before we release the GPS (seconds)
+GPS_REFIX         = 1      # How fast the GPS should get a fix when coming out of standby (seconds)
+GPS_FRESH         = 2      # How old a fix received on standby may be to be used right away (seconds)
+RACE_ACCURACY     = 100    # The accuracy which ends a race between sources
+RACE_BUDGET       = {      # Per kind of source, the worst accuracy a race considers (meters) and how long it may take (seconds)
+    "wifi": (200, 15),
+    "gsm":  (1500, TIMEOUT_GSM),
+    "gps":  (MIN_ACCURACY_GPS, TIMEOUT_GPS),
+}
+RACE_REFINE       = 5      # How long we keep refining after a race has been won
+PROGRESSIVE_FACTOR= 2      # How much a refinement must improve the accuracy of a published fix to supersede it
+PROGRESSIVE_EXTRA = 2      # How many refinements we publish per update at most
+FIX_BUFFER_SIZE   = 128    # How many raw fixes we keep around
+MEMORY_LOW_FIXES  = 16     # How many raw fixes we keep around when memory is low
+MEMORY_LOW_RESULTS= 8      # How many Skyhook results we remember when memory is low
+UPLOAD_BATCH_SIZE = 50     # How many entries we are allowed to pack in a single HTTP batch request
+UPLOAD_RETRIES    = 2      # How often a failing batch is retried right away
+UPLOAD_RETRY_DELAY= 1      # How long to wait before retrying a batch, doubled on each retry (seconds)
+UPLOAD_BACKOFF    = 60     # How long to wait after a failed upload, doubled on each failure (seconds)
+UPLOAD_BACKOFF_MAX= 900    # The longest we wait after a failed upload (seconds)
+UPLOAD_BREAKER    = 3      # After how many failed uploads in a row we stop connecting for them
+UPLOAD_BREAKER_TIME = 60   # For how long we stop connecting for uploads (minutes)
+UPLOAD_DEDUP_SIZE = 1000   # How many uploaded timestamps we remember
+UPLOAD_DEDUP_TTL  = 86400  # How long we remember an uploaded timestamp (seconds)
+CACHE_MAX_ENTRIES = 5000   # How many entries we keep around when we can't upload (oldest ones get dropped)
+JOURNAL_FILE      = 'latitude.journal'  # Where to persist the cache
+JOURNAL_SYNC      = 30     # How long appended entries can stay in the page cache before being synced (seconds)
+JOURNAL_SYNC_SIZE = 10     # How many appended entries force an early sync
+HISTORY_DIR       = 'latitude.history'  # Where to keep the daily segments of the fix history
+HISTORY_KEYFRAME  = 256    # How many records at most between two keyframes (where decoding can start)
+HISTORY_INTERVAL  = 60     # How often at most we record a fix in the history, unless it's more accurate (seconds)
+BSSID_INDEX_FILE  = 'latitude.bssid'    # Where to store the known access points
+BSSID_FLUSH       = 300    # How long learned access points can stay in memory before being written out (seconds)
+BSSID_FLUSH_SIZE  = 100    # How many learned access points force an early write
+WIFI_RANGE        = 50     # The expected range of an access point
+WIFI_LEARN_AGE    = 10     # How long a scan is considered to describe our surroundings (seconds)
+WIFI_RSSI         = -50    # The signal strength we assume when the scan doesn't report one (dBm)
+WIFI_INTERFACE    = 'wlan0'  # Which interface to scan on
+PLACE_FILE        = 'latitude.places'   # Where to store the learned places
+PLACE_RADIUS      = 100    # How large a place is (meters)
+PLACE_VISITS      = 3      # How many fixes at a place before we trust its fingerprint
+PLACE_MATCH       = 0.6    # Which fraction of the visible access points must belong to a place
+PLACE_UPDATE      = 60     # How often to update while staying at a known place (minutes)
+PLACE_SAVE        = 300    # How long learned places can stay in memory before being written out (seconds)
+CELL_FILE         = 'latitude.cells'    # Where to store the known cell positions
+CELL_RANGE        = 500    # The minimal accuracy we attribute to a cell position (meters)
+CELL_SAVE         = 300    # How long learned cells can stay in memory before being written out (seconds)
+CELL_MCC_DISTANCE = 20000  # How far from the known serving cell a fix must lie to be taken for a country-level one (meters)
+SKYHOOK_POOL_SIZE = 2      # How many idle connections to Skyhook we keep alive
+SKYHOOK_CACHE_SIZE= 64     # How many Skyhook results we remember
+SKYHOOK_CACHE_TTL = 3600   # How long we remember a Skyhook result (seconds)
+CREDENTIALS_FILE  = 'latitude.dat'      # Where to store the Latitude credentials (per account)
+DISCOVERY_FILE    = 'latitude.discovery'  # Where to keep the Latitude API description
+STATS_FILE        = 'latitude.stats'    # Where to export the counters and histograms
+STATS_SAVE        = 60     # How often at most to rewrite the statistics file (seconds)
 
 
 #
 # Auxiliary
 #
 
-class Location:
+def distance(lat1, lng1, lat2, lng2):
+    # Great-circle distance in meters (haversine)
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lng2-lng1)/2)**2
+    return 6371000 * 2 * math.asin(math.sqrt(min(1, a)))
+
+def backoff(attempt, base, limit):
+    # Exponential back-off with jitter, so retries don't happen in lockstep
+    delay = min(limit, base * 2 ** attempt)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+def accountFile(filename, account):
+    # Other accounts than the default one keep their state next to it
+    if account is None:
+        return filename
+    base, extension = os.path.splitext(filename)
+    return "%s-%s%s" % (base, account, extension)
+
+class Clock:
+    # Wall-clock time and main loop timers (see simulation.py for a replacement)
+    def time(self):
+        return time.time()
+    def timeout_add(self, interval, callback, *args):
+        return gobject.timeout_add(interval, callback, *args)
+    def idle_add(self, callback, *args):
+        return gobject.idle_add(callback, *args)
+    def source_remove(self, tag):
+        return gobject.source_remove(tag)
+
+clock = Clock()
+
+class Metrics:
+    # Counters and histograms, exported by rewriting a file when they changed
+    
+    # Member data
+    logger = logging.getLogger('Metrics')
+    buckets = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000)
+    filename = None
+    interval = 0
+    saved = None
+    changed = False
+    
+    # Constructor
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()    # some are updated from workers
+    
+    # Actions
+    def count(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            self.changed = True
+        finally:
+            self.lock.release()
+    def observe(self, name, value):
+        # Keep the count, the sum and a count per bucket
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0, [0] * (len(self.buckets) + 1)]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2][bisect.bisect_left(self.buckets, value)] += 1
+            self.changed = True
+        finally:
+            self.lock.release()
+    def export(self, filename, interval):
+        # Don't wake up for this, but piggyback on the updates (see flush)
+        self.filename = filename
+        self.interval = interval
+    def flush(self):
+        # Rewrite the file if something changed, but not too often
+        if self.filename is None or not self.changed:
+            return
+        if self.saved is not None and clock.time() - self.saved < self.interval:
+            return
+        self.save()
+    def save(self):
+        # One "name value" pair per line, with cumulative buckets
+        self.saved = clock.time()
+        self.lock.acquire()
+        try:
+            self.changed = False
+            lines = ["%s %s" % (name, value) for (name, value) in sorted(self.counters.items())]
+            for (name, (count, total, buckets)) in sorted(self.histograms.items()):
+                lines.append("%s.count %d" % (name, count))
+                lines.append("%s.sum %s" % (name, total))
+                cumulative = 0
+                for (bound, bucket) in zip(self.buckets + ("inf", ), buckets):
+                    cumulative += bucket
+                    lines.append("%s.le.%s %d" % (name, bound, cumulative))
+        finally:
+            self.lock.release()
+        
+        try:
+            temporary = self.filename + '.tmp'
+            handle = open(temporary, 'w')
+            handle.write("\n".join(lines) + "\n")
+            handle.close()
+            os.rename(temporary, self.filename)
+        except Exception, err:
+            self.logger.error("Could not export statistics: %s", str(err))
+
+metrics = Metrics()
+
+class WorkerPool:
+    # Member data
+    logger = logging.getLogger('WorkerPool')
+    pid = None
+    
+    # Constructor
+    def __init__(self, size):
+        self.size = size
+    
+    # Actions
+    def submit(self, function, args=(), callback=None, errback=None):
+        # Run the function in a worker, and pass its result or exception back to the main loop
+        if self.pid != os.getpid():
+            self._spawn()
+        self.queue.put((function, args, callback, errback))
+    
+    # Auxiliary
+    def _spawn(self):
+        # Threads don't survive a fork, so (re)start them in the process that needs them
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        for i in range(self.size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+    def _work(self):
+        while True:
+            function, args, callback, errback = self.queue.get()
+            try:
+                result = function(*args)
+            except Exception, err:
+                if errback is not None:
+                    clock.idle_add(self._deliver, errback, err)
+                else:
+                    self.logger.error("Unhandled error in worker: %s", str(err))
+                continue
+            if callback is not None:
+                clock.idle_add(self._deliver, callback, result)
+    def _deliver(self, callback, value):
+        callback(value)
+        return False
+
+class Task:
+    # A unit of work on the main loop, with a deadline
+    
+    # Member data
+    logger = logging.getLogger('Task')
+    cancelled = False
+    timeout = None
+    
+    # Constructor
+    def __init__(self, name, deadline, callback):
+        self.name = name
+        self.callback = callback
+        self.started = clock.time()
+        self.timeout = clock.timeout_add(int(deadline * 1000), self.onDeadline)
+    
+    # Events
+    def onDeadline(self):
+        self.logger.warning("Task '%s' exceeded its deadline", self.name)
+        self.timeout = None
+        self.cancelled = True
+        self.callback(self)
+        return False
+    
+    # Actions
+    def cancel(self):
+        self.cancelled = True
+        self.finish()
+    def finish(self):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+
+class Watchdog:
+    # Detects callbacks blocking the main loop, by means of a heartbeat
+    
+    # Member data
+    logger = logging.getLogger('Watchdog')
+    
+    # Constructor
+    def __init__(self, budget):
+        self.budget = budget / 1000.0
+        self.beat = time.time()
+        self.thread = threading.current_thread()
+        gobject.timeout_add(budget / 2, self.onBeat)
+        watcher = threading.Thread(target=self._watch)
+        watcher.daemon = True
+        watcher.start()
+    
+    # Events
+    def onBeat(self):
+        self.beat = time.time()
+        return True
+    
+    # Auxiliary
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.budget / 2)
+            beat = self.beat
+            if time.time() - beat > self.budget and beat != reported:
+                reported = beat
+                frame = sys._current_frames().get(self.thread.ident)
+                self.logger.warning("Main loop blocked for more than %d ms in:\n%s",
+                    self.budget * 1000, "".join(traceback.format_stack(frame)))
+
+class LRUCache:
+    # Constructor
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    # Actions
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None or clock.time() - entry[1] > self.ttl:
+                return None
+            self.entries[key] = entry
+            return entry[0]
+        finally:
+            self.lock.release()
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, clock.time())
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+    def resize(self, size):
+        self.lock.acquire()
+        try:
+            self.size = size
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+class Location(object):
     # Member data
-    lat=0
-    lng=0
-    alt=0
-    acc=9999
-    alt=0
-    altacc=0
-    head=0
-    speed=0
-    time=0
+    __slots__ = ('lat', 'lng', 'alt', 'acc', 'altacc', 'head', 'speed', 'time', 'estimate', 'covariance', 'place', 'source')
     
+    # Constructor
+    def __init__(self):
+        self.lat=0
+        self.lng=0
+        self.alt=0
+        self.acc=9999
+        self.altacc=0
+        self.head=0
+        self.speed=0
+        self.time=0
+        self.estimate=None      # fused (lat, lng)
+        self.covariance=None    # of the fused estimate (m^2, east/north)
+        self.place=None         # identifier of the known place we're at
+        self.source=None        # where the fix came from (eg. "gps" or "skyhook")
+    
+    def getTimestamp(self):
+        # Latitude knows entries by their timestamp, which makes retries idempotent
+        return int(self.time*1000)
     def getData(self):
         data = {
             "data": {
@@ -71,7 +412,7 @@ class Location:
               "latitude": self.lat,
               "longitude": self.lng,
               "accuracy": self.acc,
-              "timestampMs":int(self.time*1000),
+              "timestampMs":self.getTimestamp(),
               #"altitude": self.alt,
               #"altitudeAccuracy": self.altacc,
               #"heading": self.head,
@@ -80,18 +421,477 @@ class Location:
         }
         return data
 
+class PositionFilter:
+    # Constant-velocity Kalman filter, in meters around an origin
+    
+    # Member data
+    time = None
+    
+    # Actions
+    def update(self, lat, lng, acc, speed, head, timestamp):
+        # Speed in km/h and heading in degrees, as given by liblocation
+        acc = max(float(acc), FUSION_MIN_ACCURACY)   # a zero variance would make the filter singular
+        if self.time is None or timestamp - self.time > FUSION_RESET:
+            self.origin = (lat, lng)
+            self.x = [0.0, 0.0, 0.0, 0.0]
+            self.P = [[acc**2, 0.0, 0.0, 0.0], [0.0, acc**2, 0.0, 0.0], [0.0, 0.0, 50.0**2, 0.0], [0.0, 0.0, 0.0, 50.0**2]]
+        else:
+            self._predict(max(0.0, timestamp - self.time))
+        self.time = timestamp
+        
+        self._correct(0, 1, self._project(lat, lng), acc**2)
+        if speed == speed and head == head and speed > 0:
+            velocity = (speed / 3.6 * math.sin(math.radians(head)), speed / 3.6 * math.cos(math.radians(head)))
+            self._correct(2, 3, velocity, FUSION_VELOCITY**2)
+    def estimate(self):
+        lat = self.origin[0] + math.degrees(self.x[1] / 6371000)
+        lng = self.origin[1] + math.degrees(self.x[0] / (6371000 * math.cos(math.radians(self.origin[0]))))
+        return (lat, lng)
+    def covariance(self):
+        return ((self.P[0][0], self.P[0][1]), (self.P[1][0], self.P[1][1]))
+    def accuracy(self):
+        if self.time is None:
+            return float('inf')
+        return math.sqrt(max(self.P[0][0], self.P[1][1]))
+    def speed(self):
+        # In m/s
+        if self.time is None:
+            return 0.0
+        return math.hypot(self.x[2], self.x[3])
+    def attach(self, location):
+        location.estimate = self.estimate()
+        location.covariance = self.covariance()
+    
+    # Auxiliary
+    def _project(self, lat, lng):
+        return (math.radians(lng - self.origin[1]) * 6371000 * math.cos(math.radians(self.origin[0])),
+                math.radians(lat - self.origin[0]) * 6371000)
+    def _predict(self, dt):
+        x, P = self.x, self.P
+        x[0] += dt * x[2]
+        x[1] += dt * x[3]
+        
+        # P = F P F' + Q
+        F = [[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]]
+        FP = [[sum(F[i][k] * P[k][j] for k in range(4)) for j in range(4)] for i in range(4)]
+        P = [[sum(FP[i][k] * F[j][k] for k in range(4)) for j in range(4)] for i in range(4)]
+        q = FUSION_NOISE**2
+        for (p, v) in ((0, 2), (1, 3)):
+            P[p][p] += q * dt**4 / 4
+            P[p][v] += q * dt**3 / 2
+            P[v][p] += q * dt**3 / 2
+            P[v][v] += q * dt**2
+        self.P = P
+    def _correct(self, a, b, z, r):
+        # Measure the state elements a and b, with variance r
+        x, P = self.x, self.P
+        S = [[P[a][a] + r, P[a][b]], [P[b][a], P[b][b] + r]]
+        det = S[0][0]*S[1][1] - S[0][1]*S[1][0]
+        Sinv = [[S[1][1]/det, -S[0][1]/det], [-S[1][0]/det, S[0][0]/det]]
+        K = [[P[i][a]*Sinv[0][0] + P[i][b]*Sinv[1][0], P[i][a]*Sinv[0][1] + P[i][b]*Sinv[1][1]] for i in range(4)]
+        y = (z[0] - x[a], z[1] - x[b])
+        for i in range(4):
+            x[i] += K[i][0]*y[0] + K[i][1]*y[1]
+        self.P = [[P[i][j] - K[i][0]*P[a][j] - K[i][1]*P[b][j] for j in range(4)] for i in range(4)]
+
+class FixBuffer:
+    # Ring buffer of raw fixes, stored column-wise so it doesn't allocate
+    
+    # Member data
+    columns = ('lat', 'lng', 'alt', 'acc', 'altacc', 'head', 'speed', 'time')
+    
+    # Constructor
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.index = -1
+        for column in self.columns:
+            setattr(self, column, array.array('d', [0]) * size)
+        self.mode = array.array('b', [0]) * size
+    
+    # Actions
+    def push(self, mode, fix, timestamp):
+        # Store a liblocation fix tuple, and return its index
+        index = (self.index + 1) % self.size
+        self.mode[index] = mode
+        self.time[index] = timestamp
+        self.lat[index] = fix[4]
+        self.lng[index] = fix[5]
+        self.acc[index] = fix[6]/100
+        self.alt[index] = fix[7]
+        self.altacc[index] = fix[8]
+        self.head[index] = fix[9]
+        self.speed[index] = fix[11]
+        self.index = index
+        self.count = min(self.count + 1, self.size)
+        return index
+    def get(self, index):
+        newLocation = Location()
+        for column in self.columns:
+            setattr(newLocation, column, getattr(self, column)[index])
+        return newLocation
+    def recent(self, count):
+        # Indices of the most recent fixes, newest first
+        return [(self.index - i) % self.size for i in range(min(count, self.count))]
+    def resize(self, size):
+        # Keep the most recent fixes, and return the new index of the newest one
+        order = list(reversed(self.recent(size)))
+        for column in self.columns + ('mode', ):
+            old = getattr(self, column)
+            new = array.array(old.typecode, [old[index] for index in order])
+            setattr(self, column, new + array.array(old.typecode, [0]) * (size - len(order)))
+        self.size = size
+        self.count = len(order)
+        self.index = len(order) - 1
+        return self.index
+
+class Journal:
+    # Auxiliary
+    class Operation:
+        APPEND = 1
+        REPLACE = 2
+    
+    # Member data
+    logger = logging.getLogger('Journal')
+    header = struct.Struct('<II')   # length and checksum of the payload
+    payload = struct.Struct('<B8d') # operation and location data
+    file = None
+    records = 0
+    pending = 0
+    timeout = None
+    
+    # Constructor
+    def __init__(self, filename):
+        self.filename = filename
+    
+    # Actions
+    def replay(self):
+        # Returns the entries recorded in the journal, and opens it for appending
+        try:
+            stream = open(self.filename, 'rb')
+            data = stream.read()
+            stream.close()
+        except IOError:
+            data = ''
+        
+        entries = []
+        self.records = 0
+        offset = 0
+        while offset + self.header.size <= len(data):
+            length, checksum = self.header.unpack_from(data, offset)
+            start = offset + self.header.size
+            payload = data[start:start+length]
+            if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+                break
+            operation, location = self._decode(payload)
+            if operation == self.Operation.REPLACE and len(entries) > 0:
+                entries[-1] = location
+            else:
+                entries.append(location)
+            self.records += 1
+            offset = start + length
+        
+        # Drop whatever got torn off by a crash
+        self.file = open(self.filename, 'ab')
+        if offset != len(data):
+            self.logger.warning("Discarding %d bytes of damaged journal", len(data) - offset)
+            self.file.truncate(offset)
+        
+        self.logger.info("Replayed %d entries from the journal", len(entries))
+        return entries
+    def append(self, location):
+        self._write(self.Operation.APPEND, location)
+    def replace(self, location):
+        self._write(self.Operation.REPLACE, location)
+    def compact(self, entries):
+        # Rewrite the journal with only the given entries, atomically
+        filename = self.filename + '.tmp'
+        stream = open(filename, 'wb')
+        for entry in entries:
+            stream.write(self._encode(self.Operation.APPEND, entry))
+        stream.flush()
+        os.fsync(stream.fileno())
+        stream.close()
+        os.rename(filename, self.filename)
+        
+        self.file.close()
+        self.file = open(self.filename, 'ab')
+        self.records = len(entries)
+        self.pending = 0
+    def sync(self):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+        
+        if self.pending > 0:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        
+        return False
+    
+    # Auxiliary
+    def _write(self, operation, location):
+        # Flush right away (survives a crash of the process), but batch up
+        # the fsync's (which are needed to survive a crash of the device)
+        self.file.write(self._encode(operation, location))
+        self.file.flush()
+        self.records += 1
+        self.pending += 1
+        if self.pending >= JOURNAL_SYNC_SIZE:
+            self.sync()
+        elif self.timeout == None:
+            self.timeout = clock.timeout_add(JOURNAL_SYNC * 1000, self.sync)
+    def _encode(self, operation, location):
+        payload = self.payload.pack(operation,
+            location.lat, location.lng, location.alt, location.acc,
+            location.altacc, location.head, location.speed, location.time)
+        return self.header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+    def _decode(self, payload):
+        fields = self.payload.unpack(payload)
+        location = Location()
+        (location.lat, location.lng, location.alt, location.acc,
+            location.altacc, location.head, location.speed, location.time) = fields[1:]
+        return fields[0], location
+
+class History:
+    # Where we've been, in daily segments of fixed-width records which are
+    # delta-encoded against the previous one, except for a keyframe every so
+    # often (of which each segment has an index, for range queries)
+    
+    # Member data
+    logger = logging.getLogger('History')
+    delta = struct.Struct('<HhhBB')     # time (s), position (1e-6 degrees) relative to the previous record, accuracy and source
+    key = struct.Struct('<HIBB')        # marker, time (s since the start of the day), accuracy and source
+    position = struct.Struct('<ii')     # position of the keyframe (1e-6 degrees), in the next record
+    entry = struct.Struct('<II')        # time (s since the start of the day) and record of a keyframe
+    marker = 0xFFFF
+    sources = (None, "gps", "gsm", "cell", "index", "skyhook", "place")
+    day = None
+    segment = None
+    index = None
+    records = 0
+    since = 0
+    latest = None   # time, position of the last record
+    
+    # Constructor
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        # Continue where the newest segment left off
+        days = self.days()
+        if len(days) > 0:
+            for location in self._decode(days[-1], days[-1], days[-1] + 86400, self._tail(days[-1])):
+                self.latest = (int(location.time), int(round(location.lat * 1e6)), int(round(location.lng * 1e6)))
+    
+    # Actions
+    def record(self, location):
+        t = int(location.time)
+        lat = int(round(location.lat * 1e6))
+        lng = int(round(location.lng * 1e6))
+        acc = min(255, int(round(12 * math.log(1 + max(0, location.acc), 2))))  # within 3%
+        source = self.sources.index(location.source) if location.source in self.sources else 0
+        
+        # Range queries rely on the records being in order
+        if self.latest is not None and t < self.latest[0]:
+            self.logger.debug("Ignoring a fix older than the history")
+            return False
+        
+        day = t - t % 86400
+        if day != self.day:
+            self._open(day)
+        
+        if self.latest is None or self.since >= HISTORY_KEYFRAME or self.since == 0 or \
+                t - self.latest[0] >= self.marker or \
+                abs(lat - self.latest[1]) > 32767 or abs(lng - self.latest[2]) > 32767:
+            self.index.write(self.entry.pack(t - day, self.records))
+            self.index.flush()
+            self.segment.write(self.key.pack(self.marker, t - day, acc, source) + self.position.pack(lat, lng))
+            self.records += 2
+            self.since = 1
+        else:
+            self.segment.write(self.delta.pack(t - self.latest[0], lat - self.latest[1], lng - self.latest[2], acc, source))
+            self.records += 1
+            self.since += 1
+        self.segment.flush()
+        self.latest = (t, lat, lng)
+        return True
+    def sync(self):
+        if self.segment is not None:
+            self.index.flush()
+            os.fsync(self.segment.fileno())
+            os.fsync(self.index.fileno())
+    def days(self):
+        # Returns the start of each day we have a segment of
+        days = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg'):
+                try:
+                    days.append(calendar.timegm(time.strptime(name[:-4], '%Y%m%d')))
+                except ValueError:
+                    pass
+        return sorted(days)
+    def query(self, start=None, end=None):
+        # Yields the locations between start and end, only decoding what's needed
+        for day in self.days():
+            if (start is not None and day + 86400 <= start) or (end is not None and day > end):
+                continue
+            first = day if start is None else max(day, start)
+            last = day + 86400 if end is None else end
+            for location in self._decode(day, first, last, self._seek(day, first)):
+                yield location
+    
+    # Auxiliary
+    def _filename(self, day, extension):
+        return os.path.join(self.directory, time.strftime('%Y%m%d', time.gmtime(day)) + extension)
+    def _open(self, day):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+        self.day = day
+        self.segment = open(self._filename(day, '.seg'), 'ab')
+        self.index = open(self._filename(day, '.idx'), 'ab')
+        
+        # Drop whatever got torn off by a crash, and start with a keyframe
+        size = os.fstat(self.segment.fileno()).st_size
+        if size % self.delta.size != 0:
+            self.segment.truncate(size - size % self.delta.size)
+        self.records = size // self.delta.size
+        self.since = 0
+    def _entries(self, day):
+        try:
+            stream = open(self._filename(day, '.idx'), 'rb')
+            data = stream.read()
+            stream.close()
+        except IOError:
+            return []
+        return [self.entry.unpack_from(data, offset) for offset in range(0, len(data) - self.entry.size + 1, self.entry.size)]
+    def _seek(self, day, start):
+        # The last keyframe before the start (the first record is one as well)
+        entries = self._entries(day)
+        index = bisect.bisect_right([entry[0] for entry in entries], start - day) - 1
+        if index < 0:
+            return 0
+        return entries[index][1]
+    def _tail(self, day):
+        entries = self._entries(day)
+        if len(entries) == 0:
+            return 0
+        return entries[-1][1]
+    def _decode(self, day, start, end, record):
+        try:
+            stream = open(self._filename(day, '.seg'), 'rb')
+        except IOError:
+            return
+        size = os.fstat(stream.fileno()).st_size
+        size -= size % self.delta.size
+        if size == 0:
+            stream.close()
+            return
+        data = mmap.mmap(stream.fileno(), size, access=mmap.ACCESS_READ)
+        stream.close()
+        
+        # Make sure we start at a keyframe (the index might be damaged)
+        count = size // self.delta.size
+        if record >= count or self.delta.unpack_from(data, record * self.delta.size)[0] != self.marker:
+            record = 0
+        
+        t = lat = lng = 0
+        try:
+            while record < count:
+                offset = record * self.delta.size
+                dt, dlat, dlng, acc, source = self.delta.unpack_from(data, offset)
+                if dt == self.marker:
+                    if record + 1 >= count:
+                        break   # torn keyframe
+                    marker, t, acc, source = self.key.unpack_from(data, offset)
+                    lat, lng = self.position.unpack_from(data, offset + self.delta.size)
+                    t += day
+                    record += 2
+                else:
+                    t += dt
+                    lat += dlat
+                    lng += dlng
+                    record += 1
+                if t < start:
+                    continue
+                if t > end:
+                    break
+                
+                location = Location()
+                location.time = t
+                location.lat = lat / 1e6
+                location.lng = lng / 1e6
+                location.acc = 2 ** (acc / 12.0) - 1
+                location.source = self.sources[source] if source < len(self.sources) else None
+                yield location
+        finally:
+            data.close()
+
 class ServiceWrapper:
     # Member data
     logger = logging.getLogger('ServiceWrapper')
     service = None
     
     # Constructor
-    def __init__(self):        
-        # Connect to Latitude
-        storage = Storage('latitude.dat')
+    def __init__(self, account=None):
+        # We only connect when asked to, or on the first upload
+        self.account = account
+        self.lock = threading.Lock()
+    
+    # Events
+    def onError(self, err):
+        self.logger.error("Could not connect to Latitude: %s", str(err))
+    
+    # Actions
+    def connectAsync(self):
+        # Authenticating might block, so do it in a worker
+        global pool
+        pool.submit(self._connect, errback=self.onError)
+    def upload(self, entries):
+        # Returns the entries which have been accepted by the server, and
+        # those it will never accept (the others can be retried later)
+        accepted = []
+        rejected = []
+        for offset in range(0, len(entries), UPLOAD_BATCH_SIZE):
+            pending = entries[offset:offset+UPLOAD_BATCH_SIZE]
+            for attempt in range(UPLOAD_RETRIES + 1):
+                if attempt > 0:
+                    self._sleep(backoff(attempt - 1, UPLOAD_RETRY_DELAY, UPLOAD_BACKOFF))
+                try:
+                    self._connect()
+                    done, refused, pending = self._uploadBatch(pending)
+                except Exception, err:
+                    self.logger.warning("Could not upload batch: %s", str(err))
+                    if self._status(err) == 401:
+                        self.service = None     # authenticate again
+                    continue
+                accepted.extend(done)
+                rejected.extend(refused)
+                if len(pending) == 0:
+                    break
+            if len(pending) > 0:
+                break   # the service is struggling, try again later
+        return (accepted, rejected)
+    def uploadAsync(self, entries, callback):
+        # Upload in a worker, and report back to the main loop
+        def errback(err):
+            self.logger.error("Could not upload entries: %s", str(err))
+            callback(entries, [], [])
+        global pool
+        pool.submit(self.upload, (entries,), lambda result: callback(entries, *result), errback)
+    def authorize(self):
+        # Returns valid credentials, asking the user for them if needed
+        import httplib2
+        from apiclient.oauth import FlowThreeLegged     # google-api-python-client
+        from apiclient.ext.authtools import run
+        from apiclient.ext.file import Storage
+        
+        storage = Storage(accountFile(CREDENTIALS_FILE, self.account))
         credentials = storage.get()
         if credentials is None or credentials.invalid == True:
-            auth_discovery = build("latitude", "v1").auth_discovery()
+            auth_discovery = self._build(httplib2.Http()).auth_discovery()
             flow = FlowThreeLegged(auth_discovery,
                 # You MUST have a consumer key and secret tied to a
                 # registered domain to use the latitude API.
@@ -112,35 +912,133 @@ class ServiceWrapper:
             credentials = run(flow, storage)
             if credentials is None or credentials.invalid == True:
                 raise Exception("Invalid Latitude credentials")
-        http = httplib2.Http()
-        http = credentials.authorize(http)
-        self.service = build("latitude", "v1", http=http)
+        return credentials
     
-    # Actions
-    def upload(self, entries):
-        for entry in entries:
-            self.service.location().insert(body = entry.getData()).execute()
+    # Auxiliary
+    def _connect(self):
+        # Connect to Latitude (in a worker)
+        self.lock.acquire()
+        try:
+            if self.service is None:
+                self._authenticate()
+        finally:
+            self.lock.release()
+    def _authenticate(self):
+        import httplib2
+        credentials = self.authorize()
+        http = httplib2.Http()
+        self.http = credentials.authorize(http)
+        self.service = self._build(self.http)
+    def _build(self, http):
+        # The API description hardly ever changes, so keep a copy instead of
+        # fetching it on every start
+        from apiclient.discovery import build_from_document, DISCOVERY_URI
+        uri = DISCOVERY_URI.replace('{api}', 'latitude').replace('{apiVersion}', 'v1')
+        future = self._future()
+        try:
+            document = open(DISCOVERY_FILE).read()
+            return build_from_document(document, uri, future=future, http=http)
+        except IOError:
+            pass
+        except ValueError, err:
+            self.logger.warning("Discarding damaged API description: %s", str(err))
+        
+        response, document = http.request(uri)
+        if response.status >= 400:
+            raise Exception("Could not fetch the API description: [%s %s]" % (response.status, response.reason))
+        service = build_from_document(document, uri, future=future, http=http)
+        temporary = DISCOVERY_FILE + '.tmp'
+        stream = open(temporary, 'w')
+        stream.write(document)
+        stream.close()
+        os.rename(temporary, DISCOVERY_FILE)
+        return service
+    def _future(self):
+        # What build() passes on as well: the client ships the parts the
+        # discovery service lacks, such as the OAuth details, next to itself
+        import apiclient
+        try:
+            return open(os.path.join(os.path.dirname(apiclient.__file__), 'contrib', 'latitude', 'future.json')).read()
+        except IOError:
+            return None
+    def _uploadBatch(self, entries):
+        # Returns the accepted, rejected and retryable entries
+        accepted = []
+        rejected = []
+        retry = []
+        def cbInsert(request_id, response, exception):
+            entry = entries[int(request_id)]
+            if exception is None:
+                accepted.append(entry)
+            elif self._status(exception) == 409:
+                accepted.append(entry)  # the server already has an entry with this timestamp
+            elif self._permanent(exception):
+                self.logger.error("Entry %s was rejected: %s", request_id, str(exception))
+                rejected.append(entry)
+            else:
+                self.logger.warning("Entry %s failed: %s", request_id, str(exception))
+                retry.append(entry)
+        batch = self._batch(cbInsert)
+        for index, entry in enumerate(entries):
+            batch.add(self.service.location().insert(body = entry.getData()), request_id=str(index))
+        batch.execute(http=self.http)
+        return (accepted, rejected, retry)
+    def _batch(self, callback):
+        from apiclient.http import BatchHttpRequest
+        return BatchHttpRequest(callback=callback)
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+    def _status(self, err):
+        # The HTTP status of a failed request, if any
+        try:
+            return int(err.resp.status)
+        except (AttributeError, TypeError, ValueError):
+            return None
+    def _permanent(self, err):
+        # Client errors won't go away by retrying, except for these
+        status = self._status(err)
+        return status is not None and 400 <= status < 500 and status not in (401, 403, 408, 429)
 
 class DeviceWrapper(gobject.GObject):
+    # Signals
+    __gsignals__ = {
+        "shutdown": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+        "save": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+        "memory": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (bool, )),      # whether memory is low
+        "inactivity": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (bool, )),  # whether the device is inactive
+    }
+    
     # Member data
     logger = logging.getLogger('DeviceWrapper')
-    context = osso.Context("osso_test_device_on", "0.0.1", False)
-    device = osso.DeviceState(context)
+    memory_low = False
+    inactive = False
     
     # Constructor
     def __init__(self):
         gobject.GObject.__init__(self)
+        global backend
+        self.context = backend.osso.Context("osso_test_device_on", "0.0.1", False)
+        self.device = backend.osso.DeviceState(self.context)
         
         # Register callbacks
         self.device.set_device_state_callback(self.cbState)
     
     # Events
-    def cbState(shutdown, save_unsaved_data, memory_low, system_inactivity, message):        
-        logger.debug("Shutdown: ", shutdown)
-        logger.debug("Save unsaved data: ", save_unsaved_data)
-        logger.debug("Memory low: ", memory_low)
-        logger.debug("System Inactivity: ", system_inactivity)
-        logger.debug("Message: ", message)
+    def cbState(self, shutdown, save_unsaved_data, memory_low, system_inactivity, message, user_data=None):
+        self.logger.debug("Device state changed (shutdown: %s, save unsaved data: %s, memory low: %s, system inactivity: %s, message: %s)",
+            shutdown, save_unsaved_data, memory_low, system_inactivity, message)
+        if shutdown:
+            self.emit("shutdown")
+        elif save_unsaved_data:
+            self.emit("save")
+        
+        # The other ones are states, so only report changes
+        if bool(memory_low) != self.memory_low:
+            self.memory_low = bool(memory_low)
+            self.emit("memory", self.memory_low)
+        if bool(system_inactivity) != self.inactive:
+            self.inactive = bool(system_inactivity)
+            self.emit("inactivity", self.inactive)
 
 class ConnectionWrapper(gobject.GObject):
     # Signals
@@ -152,11 +1050,14 @@ class ConnectionWrapper(gobject.GObject):
     # Member data
     logger = logging.getLogger('ConnectionWrapper')
     connected = False
-    connection = conic.Connection()
+    bearer = None
+    connected_time = 0
     
     # Constructor
     def __init__(self):
         gobject.GObject.__init__(self)
+        global backend
+        self.connection = backend.conic.Connection()
         
         # Listen for events
         self.connection.connect("connection-event", self.on_connection_event)
@@ -167,28 +1068,79 @@ class ConnectionWrapper(gobject.GObject):
         status = event.get_status()
         bearer = event.get_bearer_type()
         
-        if status == conic.STATUS_CONNECTED:
-            self.logger.debug("Device connected to %s" % bearer)
+        global backend
+        if status == backend.conic.STATUS_CONNECTED:
+            self.logger.debug("Device connected to %s", bearer)
             self.connected = True
+            self.bearer = bearer
+            self.connected_time = clock.time()
             self.emit("connected")
-        elif status == conic.STATUS_DISCONNECTED:
-            self.logger.debug("Device disconnected from %s" % bearer)
+        elif status == backend.conic.STATUS_DISCONNECTED:
+            self.logger.debug("Device disconnected from %s", bearer)
+            if self.connected:
+                metrics.count("radio.%s.seconds" % str(self.bearer).lower(), clock.time() - self.connected_time)
             self.connected = False
+            self.bearer = None
             self.emit("disconnected")
     
     # Actions
     def request(self):
-        self.connection.request_connection(conic.CONNECT_FLAG_NONE)
+        global backend
+        self.connection.request_connection(backend.conic.CONNECT_FLAG_NONE)
+
+class ConnectionPool:
+    # Member data
+    logger = logging.getLogger('ConnectionPool')
+    
+    # Constructor
+    def __init__(self, host, size):
+        self.host = host
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+    
+    # Actions
+    def acquire(self):
+        # Reuse a kept-alive connection if we have one, saving a TLS handshake
+        self.lock.acquire()
+        try:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        self.logger.debug("Opening a new connection to %s", self.host)
+        return httplib.HTTPSConnection(self.host)
+    def release(self, conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+    def clear(self):
+        # Close the idle connections
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for conn in idle:
+            conn.close()
 
 class Skyhook():
     # Member data    
     logger = logging.getLogger('Skyhook')
+    apihost = "api.skyhookwireless.com"
+    url = "/wps2/location"
+    pool = ConnectionPool(apihost, SKYHOOK_POOL_SIZE)
+    cache = LRUCache(SKYHOOK_CACHE_SIZE, SKYHOOK_CACHE_TTL)
     
     # Constructor
-    def __init__(self, bssid):
-        self.apihost="api.skyhookwireless.com"
-        self.url="/wps2/location"
-        self.bssid=self._validateBssid(bssid)
+    def __init__(self, accesspoints):
+        self.bssids=[self._validateBssid(accesspoint.bssid) for accesspoint in accesspoints]
         self.results={}
         self.reqStr = """<?xml version='1.0'?>
             <LocationRQ xmlns='http://skyhookwireless.com/wps/2005' version='2.6' street-address-lookup='full'>
@@ -197,12 +1149,13 @@ class Skyhook():
                   <username>beta</username>
                   <realm>js.loki.com</realm>
                 </simple>
-              </authentication>
+              </authentication>%s
+            </LocationRQ>""" % "".join(["""
               <access-point>
                 <mac>%s</mac>
-                <signal-strength>-50</signal-strength>
-              </access-point>
-            </LocationRQ>""" % self.bssid
+                <signal-strength>%d</signal-strength>
+              </access-point>""" % (bssid, accesspoint.rssi or WIFI_RSSI)
+                for (bssid, accesspoint) in zip(self.bssids, accesspoints)])
 
     def _validateBssid(self, bssid):
         if not re.compile(r"^([\dabcdef]{2}:){5}[\dabcdef]{2}$", re.I).search(bssid):
@@ -217,29 +1170,577 @@ class Skyhook():
             self.results["Longitude"] = match.group(2)
         else:
             raise Exception("Couldn't find basic attributes in response.")
+        match = re.compile(r"<hpe>([^<]*)</hpe>").search(xml)
+        if match:
+            self.results["Accuracy"] = match.group(1)
 
-    def getLocation(self):
+    def _request(self, conn):
         try:
             dataLen=len(self.reqStr)
-            conn = httplib.HTTPSConnection(self.apihost)
             conn.putrequest("POST", self.url)
             conn.putheader("Content-type", "text/xml")
             conn.putheader("Content-Length", str(dataLen))
             conn.endheaders()
             conn.send(self.reqStr)
-        except (socket.gaierror, socket.error):
-            raise Exception("There was a problem when connecting to host [%s]" % (self.apihost))
+            return conn.getresponse()
+        except (socket.gaierror, socket.error, httplib.HTTPException):
+            conn.close()
+            raise
 
-        response = conn.getresponse()
+    def getLocation(self):
+        key = frozenset(self.bssids)
+        results = self.cache.get(key)
+        if results is not None:
+            self.logger.debug("Found %d access points in the cache", len(key))
+            metrics.count("skyhook.hit")
+            self.results = results
+            return self.results
+        metrics.count("skyhook.miss")
+        
+        started = clock.time()
+        conn = self.pool.acquire()
+        try:
+            response = self._request(conn)
+        except (socket.gaierror, socket.error, httplib.HTTPException):
+            # The server might have dropped our kept-alive connection, try once more
+            conn = httplib.HTTPSConnection(self.apihost)
+            try:
+                response = self._request(conn)
+            except (socket.gaierror, socket.error, httplib.HTTPException):
+                raise Exception("There was a problem when connecting to host [%s]" % (self.apihost))
+
+        xml = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.release(conn)
         if response.status != 200:
             raise Exception("There was an error from the sever: [%s %s]" % (response.status, response.reason))
 
-        xml = response.read()
         if re.compile(r"Unable to locate").search(xml):
-            raise Exception("Unable to find info for [%s]" % bssid)
+            raise Exception("Unable to find info for [%s]" % ", ".join(self.bssids))
 
         self._parseResponse(xml)
+        metrics.observe("skyhook.seconds", clock.time() - started)
+        self.cache.put(key, self.results)
         return self.results
+    def getLocationAsync(self, callback, errback):
+        # Look up in a worker, and report back to the main loop
+        global pool
+        pool.submit(self.getLocation, (), callback, errback)
+
+class BSSIDIndex:
+    # Member data
+    logger = logging.getLogger('BSSIDIndex')
+    record = struct.Struct('>6siiHH')   # MAC, position (1e-7 degrees), accuracy and observation count
+    mapping = None
+    size = 0
+    timeout = None
+    
+    # Constructor
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = {}
+        self._open()
+    
+    # Actions
+    def get(self, bssid):
+        # Returns a (lat, lng, acc, count) tuple, or None if the access point is unknown
+        key = self._key(bssid)
+        if key in self.pending:
+            return self.pending[key]
+        return self._search(key)
+    def learn(self, bssid, lat, lng, acc):
+        key = self._key(bssid)
+        acc = max(acc, WIFI_RANGE)
+        known = self.get(bssid)
+        if known is not None:
+            # Inverse-variance weighting, which keeps the best estimate stable
+            oldlat, oldlng, oldacc, count = known
+            w_old = count / float(oldacc**2)
+            w_new = 1 / float(acc**2)
+            lat = (oldlat*w_old + lat*w_new) / (w_old + w_new)
+            lng = (oldlng*w_old + lng*w_new) / (w_old + w_new)
+            acc = max(WIFI_RANGE, min(oldacc, acc))
+            count = min(count + 1, 0xffff)
+        else:
+            count = 1
+        self.pending[key] = (lat, lng, min(int(acc), 0xffff), count)
+        
+        if len(self.pending) >= BSSID_FLUSH_SIZE:
+            self.flush()
+        elif self.timeout == None:
+            self.timeout = clock.timeout_add(BSSID_FLUSH * 1000, self.flush)
+    def locate(self, accesspoints):
+        # Weighted centroid of all known access points, favouring the strong ones
+        known = []
+        weights = []
+        for accesspoint in accesspoints:
+            entry = self.get(accesspoint.bssid)
+            if entry is not None:
+                lat, lng, acc, count = entry
+                rssi = accesspoint.rssi if accesspoint.rssi is not None else WIFI_RSSI
+                weight = count / float(acc**2) * 10 ** (rssi / 20.0)
+                known.append(entry)
+                weights.append(weight)
+        if len(known) == 0:
+            return None
+        total = sum(weights)
+        newLocation = Location()
+        newLocation.time = clock.time()
+        newLocation.lat = sum(w*entry[0] for (w, entry) in zip(weights, known)) / total
+        newLocation.lng = sum(w*entry[1] for (w, entry) in zip(weights, known)) / total
+        
+        # The accuracy accounts for both the spread of the access points and their own accuracy
+        variance = sum(w * (entry[2]**2 + distance(newLocation.lat, newLocation.lng, entry[0], entry[1])**2)
+                       for (w, entry) in zip(weights, known)) / total
+        newLocation.acc = math.sqrt(variance)
+        self.logger.debug("Located using %d out of %d access points", len(known), len(accesspoints))
+        return newLocation
+    def flush(self):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+        if len(self.pending) == 0:
+            return False
+        
+        # Merge the pending entries into a new, sorted file
+        pending = sorted(self.pending.items())
+        filename = self.filename + '.tmp'
+        stream = open(filename, 'wb')
+        i = 0
+        for index in range(self.size):
+            key, data = self._read(index)
+            while i < len(pending) and pending[i][0] < key:
+                stream.write(self._pack(*pending[i]))
+                i += 1
+            if i < len(pending) and pending[i][0] == key:
+                stream.write(self._pack(*pending[i]))
+                i += 1
+            else:
+                stream.write(self.mapping[index*self.record.size:(index+1)*self.record.size])
+        while i < len(pending):
+            stream.write(self._pack(*pending[i]))
+            i += 1
+        stream.flush()
+        os.fsync(stream.fileno())
+        stream.close()
+        os.rename(filename, self.filename)
+        
+        self.logger.debug("Wrote %d access points to the index", len(pending))
+        self.pending = {}
+        self._open()
+        return False
+    
+    # Auxiliary
+    def _open(self):
+        if self.mapping is not None:
+            self.mapping.close()
+        self.mapping = None
+        self.size = 0
+        try:
+            stream = open(self.filename, 'rb')
+        except IOError:
+            return
+        length = os.fstat(stream.fileno()).st_size
+        if length >= self.record.size:
+            self.mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = length // self.record.size
+        stream.close()
+    def _key(self, bssid):
+        # Big-endian 48-bit MAC, so that byte order equals numeric order
+        return struct.pack('>Q', int(bssid.replace(':', ''), 16))[2:]
+    def _pack(self, key, data):
+        lat, lng, acc, count = data
+        return self.record.pack(key, int(round(lat*1e7)), int(round(lng*1e7)), acc, count)
+    def _read(self, index):
+        key, lat, lng, acc, count = self.record.unpack_from(self.mapping, index*self.record.size)
+        return key, (lat/1e7, lng/1e7, acc, count)
+    def _search(self, key):
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle*self.record.size
+            current = self.mapping[offset:offset+6]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return self._read(middle)[1]
+        return None
+
+class AccessPoint:
+    # Member data
+    bssid = None
+    rssi = None     # dBm
+    channel = None
+    age = None      # seconds since the last beacon
+
+class WIFIScanner:
+    # Member data
+    logger = logging.getLogger('WIFIScanner')
+    proc = None
+    watch = None
+    
+    # Constructor
+    def __init__(self, interface):
+        self.interface = interface
+        self.callbacks = []
+        self.buffer = ''
+        self.results = []
+    
+    # Actions
+    def scan(self, callback):
+        # The callback receives a list of AccessPoint's once the scan is done
+        self.callbacks.append(callback)
+        if self.proc is not None:
+            return  # piggyback on the running scan
+        
+        self.buffer = ''
+        self.results = []
+        try:
+            self.proc = subprocess.Popen(['iwlist', self.interface, 'scan'],
+                stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'), close_fds=True)
+        except OSError, err:
+            self.logger.error("Could not scan for access points: %s", str(err))
+            self.proc = None
+            self._finish()
+            return
+        self.watch = gobject.io_add_watch(self.proc.stdout, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, self.onOutput)
+    
+    # Events
+    def onOutput(self, source, condition):
+        data = ''
+        if condition & gobject.IO_IN:
+            data = os.read(self.proc.stdout.fileno(), 4096)
+        if data:
+            # Parse the complete lines as they come in
+            lines = (self.buffer + data).split('\n')
+            self.buffer = lines.pop()
+            for line in lines:
+                self._parse(line)
+            return True
+        
+        # End of output
+        self._parse(self.buffer)
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+        self.watch = None
+        self.logger.debug("Found %d access points", len(self.results))
+        self._finish()
+        return False
+    
+    # Auxiliary
+    def _parse(self, line):
+        line = line.strip()
+        match = re.search(r'Address: ([0-9A-Fa-f:]{17})', line)
+        if match:
+            accesspoint = AccessPoint()
+            accesspoint.bssid = match.group(1)
+            self.results.append(accesspoint)
+            return
+        if len(self.results) == 0:
+            return
+        accesspoint = self.results[-1]
+        match = re.search(r'Signal level[=:](-?\d+) dBm', line)
+        if match:
+            accesspoint.rssi = int(match.group(1))
+        match = re.match(r'Channel:(\d+)', line)
+        if match:
+            accesspoint.channel = int(match.group(1))
+        match = re.search(r'Last beacon: (\d+)ms ago', line)
+        if match:
+            accesspoint.age = int(match.group(1)) / 1000.0
+    def _finish(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            callback(self.results)
+
+class CellCache:
+    # Member data
+    logger = logging.getLogger('CellCache')
+    net = None
+    probed = False
+    timeout = None
+    serving = None
+    
+    # Constructor
+    def __init__(self, filename):
+        self.filename = filename
+        self.cells = {}
+        try:
+            stream = open(self.filename, 'rb')
+            self.cells = pickle.load(stream)
+            stream.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+        
+        global backend
+        self.dbus = backend.dbus
+    
+    # Events
+    def onRegistration(self, status, lac, cid, mnc, mcc, network_type, services, error=0):
+        # The status query has an error code, the signal hasn't
+        if error != 0 or cid == 0:
+            self.serving = None
+        else:
+            self.serving = (int(mcc), int(mnc), int(lac), int(cid))
+    
+    # Actions
+    def current(self):
+        # Returns the (MCC, MNC, LAC, CID) of the serving cell, or None
+        if not self.probed:
+            self._connect()
+        return self.serving
+    def get(self, cell):
+        # Returns a (lat, lng, acc) tuple, or None if the cell is unknown
+        if cell is None:
+            return None
+        return self.cells.get(cell)
+    def learn(self, cell, lat, lng, acc):
+        if cell is None:
+            return
+        acc = max(acc, CELL_RANGE)
+        known = self.cells.get(cell)
+        if known is not None:
+            oldlat, oldlng, oldacc = known
+            w_old = 1 / float(oldacc**2)
+            w_new = 1 / float(acc**2)
+            lat = (oldlat*w_old + lat*w_new) / (w_old + w_new)
+            lng = (oldlng*w_old + lng*w_new) / (w_old + w_new)
+            acc = min(oldacc, acc)
+        self.cells[cell] = (lat, lng, acc)
+        
+        if self.timeout == None:
+            self.timeout = clock.timeout_add(CELL_SAVE * 1000, self.save)
+    def save(self):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+        
+        filename = self.filename + '.tmp'
+        stream = open(filename, 'wb')
+        pickle.dump(self.cells, stream, pickle.HIGHEST_PROTOCOL)
+        stream.flush()
+        os.fsync(stream.fileno())
+        stream.close()
+        os.rename(filename, self.filename)
+        return False
+    
+    # Auxiliary
+    def _connect(self):
+        # Only probe the cellular service once we need it
+        self.probed = True
+        try:
+            bus = self.dbus.SystemBus()
+            self.net = bus.get_object('com.nokia.phone.net', '/com/nokia/phone/net', introspect=False)
+            
+            # Ask for the serving cell once, and follow the changes instead
+            # of blocking the main loop with a query on every fix
+            bus.add_signal_receiver(self.onRegistration, signal_name='registration_status_change',
+                dbus_interface='Phone.Net', path='/com/nokia/phone/net')
+            self.onRegistration(*self.net.get_registration_status(dbus_interface='Phone.Net'))
+        except self.dbus.DBusException, err:
+            self.logger.error("Could not connect to the cellular service: %s", str(err))
+
+class Place:
+    # Constructor
+    def __init__(self, identifier, lat, lng):
+        self.identifier = identifier
+        self.lat = lat
+        self.lng = lng
+        self.visits = 0
+        self.bssids = {}    # BSSID -> how many times we saw it here
+
+class PlaceIndex:
+    # Member data
+    logger = logging.getLogger('PlaceIndex')
+    grid = 0.001    # degrees per grid cell, somewhat larger than a place
+    timeout = None
+    
+    # Constructor
+    def __init__(self, filename):
+        self.filename = filename
+        self.places = []
+        try:
+            stream = open(self.filename, 'rb')
+            self.places = pickle.load(stream)
+            stream.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+        
+        # Spatial and fingerprint lookup tables
+        self.cells = {}
+        self.owners = {}
+        for place in self.places:
+            self._register(place)
+        self.logger.info("Loaded %d places", len(self.places))
+    
+    # Actions
+    def learn(self, newLocation, accesspoints):
+        if newLocation.acc > PLACE_RADIUS:
+            return
+        place = self.near(newLocation.lat, newLocation.lng)
+        if place is None:
+            place = Place(len(self.places), newLocation.lat, newLocation.lng)
+            self.places.append(place)
+            self._register(place)
+        
+        # Running average of the position
+        place.visits += 1
+        place.lat += (newLocation.lat - place.lat) / place.visits
+        place.lng += (newLocation.lng - place.lng) / place.visits
+        for accesspoint in accesspoints:
+            place.bssids[accesspoint.bssid] = place.bssids.get(accesspoint.bssid, 0) + 1
+            self.owners.setdefault(accesspoint.bssid, set()).add(place.identifier)
+        
+        if self.timeout == None:
+            self.timeout = clock.timeout_add(PLACE_SAVE * 1000, self.save)
+    def near(self, lat, lng):
+        row, column = self._cell(lat, lng)
+        for cell in [(row+i, column+j) for i in (-1, 0, 1) for j in (-1, 0, 1)]:
+            for place in self.cells.get(cell, []):
+                if distance(lat, lng, place.lat, place.lng) <= PLACE_RADIUS:
+                    return place
+        return None
+    def match(self, accesspoints):
+        # Find the trusted place whose fingerprint covers most of the scan
+        if len(accesspoints) == 0:
+            return None
+        scores = {}
+        for accesspoint in accesspoints:
+            for identifier in self.owners.get(accesspoint.bssid, ()):
+                scores[identifier] = scores.get(identifier, 0) + 1
+        best = None
+        for identifier, score in scores.items():
+            place = self.places[identifier]
+            if place.visits >= PLACE_VISITS and score >= PLACE_MATCH * len(accesspoints):
+                if best is None or score > scores[best.identifier]:
+                    best = place
+        return best
+    def save(self):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+        
+        filename = self.filename + '.tmp'
+        stream = open(filename, 'wb')
+        pickle.dump(self.places, stream, pickle.HIGHEST_PROTOCOL)
+        stream.flush()
+        os.fsync(stream.fileno())
+        stream.close()
+        os.rename(filename, self.filename)
+        return False
+    
+    # Auxiliary
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.grid)), int(math.floor(lng / self.grid)))
+    def _register(self, place):
+        self.cells.setdefault(self._cell(place.lat, place.lng), []).append(place)
+        for bssid in place.bssids:
+            self.owners.setdefault(bssid, set()).add(place.identifier)
+
+class GPSSession:
+    # Keeps the GPS running at a low rate between lookups while we're moving,
+    # so the next lookup gets a fix right away instead of starting it again
+    
+    # Member data
+    logger = logging.getLogger('GPSSession')
+    intervals = (1, 2, 5, 10, 20, 30, 60, 120)  # as supported by liblocation
+    standby = False
+    standby_time = 0
+    still_time = None
+    acquire_time = None
+    interval = None
+    timeout = None
+    ceiling = GPS_STANDBY_INTERVAL  # the longest interval from which we still get back fast enough
+    
+    # Constructor
+    def __init__(self, control, location, callback):
+        self.control = control
+        self.location = location
+        self.callback = callback    # stops the GPS when standby runs out
+    
+    # Events
+    def onExpired(self):
+        self.timeout = None
+        if self.standby:
+            self.logger.debug("GPS on standby for too long")
+            self.callback()
+        return False
+    
+    # Actions
+    def acquire(self, method):
+        # Returns whether the GPS is still running
+        hot = self.standby
+        self.standby = False
+        self.acquire_time = clock.time() if hot else None
+        self._configure(method, 1)
+        return hot
+    def acquired(self):
+        # Adapt how long the GPS may sleep to how fast it comes back
+        if self.acquire_time is None:
+            return
+        latency = clock.time() - self.acquire_time
+        self.acquire_time = None
+        metrics.observe("gps.refix.seconds", latency)
+        if latency > GPS_REFIX:
+            self.ceiling = max(self.intervals[0], self.ceiling // 2)
+        else:
+            self.ceiling = min(GPS_STANDBY_INTERVAL, self.ceiling * 2)
+    def release(self, speed, fixed):
+        # Returns whether the GPS can be stopped, given the speed (None
+        # without a recent fix) and when the latest fix came in
+        if speed is None or speed < GPS_STILL_SPEED:
+            return True
+        if fixed > self.standby_time:
+            self.standby_time = clock.time()    # only a new fix extends the standby
+        elif clock.time() - self.standby_time > GPS_STANDBY_MAX * 60:
+            return True
+        self.logger.debug("Keeping the GPS on standby")
+        self.standby = True
+        self.still_time = None
+        self._configure(None, GPS_STANDBY_DISTANCE / speed)
+        
+        # Don't count on fixes to end the standby, they might not come in
+        if self.timeout is not None:
+            clock.source_remove(self.timeout)
+        remaining = self.standby_time + GPS_STANDBY_MAX * 60 - clock.time()
+        self.timeout = clock.timeout_add(int(max(remaining, 0) * 1000), self.onExpired)
+        return False
+    def observe(self, speed):
+        # Returns whether the GPS on standby can be stopped
+        if speed < GPS_STILL_SPEED:
+            if self.still_time is None:
+                self.still_time = clock.time()
+            elif clock.time() - self.still_time > GPS_STILL_TIME:
+                self.logger.debug("Standing still, releasing the GPS")
+                return True
+        else:
+            self.still_time = None
+            self._configure(None, GPS_STANDBY_DISTANCE / speed)
+        return False
+    def stop(self):
+        self.standby = False
+        self.interval = None
+        if self.timeout is not None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+    
+    # Auxiliary
+    def _configure(self, method, interval):
+        # Pick the longest supported interval
+        interval = max([self.intervals[0]] + [supported for supported in self.intervals if supported <= min(interval, self.ceiling)])
+        if method is not None:
+            self.control.set_properties(preferred_method = method,
+                preferred_interval = getattr(self.location, 'INTERVAL_%dS' % interval))
+        elif interval != self.interval:
+            self.logger.debug("Getting a fix every %d seconds", interval)
+            self.control.set_properties(preferred_interval = getattr(self.location, 'INTERVAL_%dS' % interval))
+        self.interval = interval
 
 class GPSWrapper(gobject.GObject):
     # Signals
@@ -255,30 +1756,50 @@ class GPSWrapper(gobject.GObject):
         GSM=1
         GPS=2
         WIFI=3
+        RACE=4      # all of the above
     class Aid:
         NONE=1
         INTERNET=2
     
     # Member data
     logger = logging.getLogger('GPSWrapper')
-    control = location.GPSDControl.get_default()
-    device = location.GPSDevice()
+    sources = {Source.GSM: "gsm", Source.GPS: "gps", Source.WIFI: "wifi", Source.RACE: "race"}
+    kinds = {"place": "wifi", "index": "wifi", "skyhook": "wifi", "cell": "gsm", "gsm": "gsm", "gps": "gps"}
     fix_tries = 0
     running = False
     owned = False
+    passive = False
     source = None
     aid = None
+    lookup = 0
+    accesspoints = []
+    accesspoints_time = 0
+    lookup_time = None
+    race_time = 0
+    control_time = None
+    control_source = None
+    latest = None
     
     # Constructor
     def __init__(self):
         gobject.GObject.__init__(self)        
+        global backend
+        self.location = backend.location
+        self.control = self.location.GPSDControl.get_default()
+        self.device = self.location.GPSDevice()
+        self.index = BSSIDIndex(BSSID_INDEX_FILE)
+        self.scanner = backend.scanner(WIFI_INTERFACE)
+        self.fixes = FixBuffer(FIX_BUFFER_SIZE)
+        self.filter = PositionFilter()
+        self.places = PlaceIndex(PLACE_FILE)
+        self.cells = CellCache(CELL_FILE)
+        self.session = GPSSession(self.control, self.location, self._stopControl)
+        
         # Listen for events
         self.control.connect("gpsd-running", self.onStart)
         self.control.connect("gpsd-stopped", self.onStop)
         self.control.connect("error-verbose", self.onError)
         self.device.connect("changed", self.onChanged)
-        
-        self._getWIFI()
     
     # Events
     def onStart(self, control):
@@ -290,12 +1811,79 @@ class GPSWrapper(gobject.GObject):
         self.running = False
         self.emit("stop")
     def onError(self, control, error):
-        self.logger.error("GPS error: %d" % error)
+        self.logger.error("GPS error: %d", error)
+    def onScan(self, lookup, accesspoints):
+        if lookup != self.lookup:
+            return      # stale lookup
+        self.accesspoints = accesspoints
+        self.accesspoints_time = clock.time()
+        
+        # Maybe we're at a known place
+        place = self.places.match(accesspoints)
+        if place is not None:
+            self.logger.debug("At known place %d", place.identifier)
+            newLocation = Location()
+            newLocation.time = clock.time()
+            newLocation.lat = place.lat
+            newLocation.lng = place.lng
+            newLocation.acc = PLACE_RADIUS
+            newLocation.place = place.identifier
+            self._fuse(newLocation)
+            self._emitFix(newLocation, "place")
+            return
+        
+        # Try the local index first, which doesn't need a data session
+        newLocation = self.index.locate(accesspoints)
+        if newLocation is not None:
+            self.places.learn(newLocation, accesspoints)
+            self._fuse(newLocation)
+            self._emitFix(newLocation, "index")
+            return
+        
+        if (self.aid == self.Aid.INTERNET and len(accesspoints) > 0):
+            # One request for the whole scan, which doesn't block the main loop
+            try:
+                global backend
+                skyhook = backend.skyhook(accesspoints)
+                skyhook.getLocationAsync(
+                    lambda result: self.onSkyhook(lookup, accesspoints, result),
+                    lambda err: self.onSkyhookError(lookup, err))
+                return
+            except Exception, err:
+                self.logger.error("Could not lookup over WIFI: %s", str(err))
+        else:
+            self.logger.info("None of the access points are known")
+        self._noWIFI()
+    def onSkyhook(self, lookup, accesspoints, result):
+        if lookup != self.lookup:
+            return False    # stale lookup
+        
+        newLocation = Location()
+        newLocation.time = clock.time()
+        newLocation.lat = float(result["Latitude"])
+        newLocation.lng = float(result["Longitude"])
+        newLocation.acc = float(result.get("Accuracy", WIFI_RANGE))
+        
+        # Each access point lies within its range of the combined fix
+        for accesspoint in accesspoints:
+            self.index.learn(accesspoint.bssid, newLocation.lat, newLocation.lng, newLocation.acc + WIFI_RANGE)
+        self.places.learn(newLocation, accesspoints)
+        
+        self._fuse(newLocation)
+        self._emitFix(newLocation, "skyhook")
+        return False
+    def onSkyhookError(self, lookup, err):
+        if lookup != self.lookup:
+            return False    # stale lookup
+        
+        self.logger.error("Could not lookup over WIFI: %s", str(err))
+        self._noWIFI()
+        return False
     def onChanged(self, device):        
         # If we don't start the control, we also don't get the signals. So use the fix
         # to determine whether the device is still running)
-        if (not self.owned):
-            if (self.device.status == location.GPS_DEVICE_STATUS_NO_FIX):
+        if (not self.owned and not self.session.standby):
+            if (self.device.status == self.location.GPS_DEVICE_STATUS_NO_FIX):
                 if (self.running):
                     self.logger.debug("External GPSD stop")
                     self.onStop(self.control);
@@ -304,66 +1892,122 @@ class GPSWrapper(gobject.GObject):
                     self.logger.debug("External GPSD start")
                     self.onStart(self.control);
         
-        # Generate a location
+        # Store the raw data
+        metrics.count("gps.raw")
         mode = device.fix[0]
-        newLocation = Location()
-        newLocation.time = time.time()
-        newLocation.lat = device.fix[4]
-        newLocation.lng = device.fix[5]
-        newLocation.acc = device.fix[6]/100
-        newLocation.alt = device.fix[7]
-        newLocation.altacc = device.fix[8]
-        newLocation.head = device.fix[9]
-        newLocation.speed = device.fix[11]
-        self.logger.debug("Received raw location data mode %d (attempt %d): lat=%f, lon=%f (accuracy of %f) alt=%f (accuracy of %f), head=%f, speed=%f" % (mode, self.fix_tries, newLocation.lat, newLocation.lng, newLocation.acc, newLocation.alt, newLocation.altacc, newLocation.head, newLocation.speed))
+        index = self.fixes.push(mode, device.fix, clock.time())
+        self.latest = index
+        fixes = self.fixes
+        self.logger.debug("Received raw location data mode %d (attempt %d): lat=%f, lon=%f (accuracy of %f) alt=%f (accuracy of %f), head=%f, speed=%f",
+            mode, self.fix_tries, fixes.lat[index], fixes.lng[index], fixes.acc[index], fixes.alt[index], fixes.altacc[index], fixes.head[index], fixes.speed[index])
                     
-        # Process the changeset
+        # Fuse everything which looks like a position
+        if mode >= 2 and fixes.acc[index] == fixes.acc[index]:
+            self.filter.update(fixes.lat[index], fixes.lng[index], fixes.acc[index],
+                               fixes.speed[index], fixes.head[index], fixes.time[index])
+        
+        # On standby, only check whether we still need the GPS
+        if self.session.standby:
+            if self.session.observe(self._speed()):
+                self._stopControl()
+            return
+        self._process(index)
+    
+    def _process(self, index):
+        fixes = self.fixes
         valid = False
-        if self.source == self.Source.GPS:
-            valid = self.processGPS(mode, newLocation)
+        if not self.owned:
+            # Piggyback on a session of another application
+            if self.passive:
+                valid = self.processAny(index)
+        elif self.source == self.Source.RACE:
+            valid = self.processAny(index)
+        elif self.source == self.Source.GPS:
+            valid = self.processGPS(index)
         elif self.source == self.Source.GSM:
-            valid = self.processGSM(mode, newLocation)
+            valid = self.processGSM(index)
             # We can't be sure to cut the lookup directly short here
             # "Application might receive MCC fixes before base station
             # information from external location server is fetched and as a
             # fallback if e.g. network is temporary unavailable. "
         if valid:            
+            # Only now we need an actual object
+            newLocation = fixes.get(index)
+            self.filter.attach(newLocation)
+            
+            # Remember where the serving cell is
+            self.cells.learn(self.cells.current(), newLocation.lat, newLocation.lng, newLocation.acc)
+            
+            # Remember where the access points around us are, if we're still close to where we scanned
+            age = clock.time() - self.accesspoints_time
+            if newLocation.acc <= MIN_ACCURACY_GPS and age <= WIFI_LEARN_AGE and age * self._speed() <= WIFI_RANGE:
+                for accesspoint in self.accesspoints:
+                    self.index.learn(accesspoint.bssid, newLocation.lat, newLocation.lng, newLocation.acc + WIFI_RANGE)
+                self.places.learn(newLocation, self.accesspoints)
+            
             self.logger.debug("Emitting GPS fix")
-            self.emit("fix", newLocation)
+            if newLocation.acc <= MIN_ACCURACY_GPS:
+                self.session.acquired()
+                self._emitFix(newLocation, "gps")
+            else:
+                self._emitFix(newLocation, "gsm")
     
-    def processGPS(self, mode, newLocation):
+    def processGPS(self, index):
+        mode = self.fixes.mode[index]
+        acc = self.fixes.acc[index]
+        
         # Ignore cached or country-size measurements
         if mode < 2:
             return False
 
         # Skip the NaN's in accuracy
-        if newLocation.acc != newLocation.acc:
+        if acc != acc:
             return False
             
         # I don't care about data of low accuracy, let's wait for a new fix
-        if newLocation.acc > MIN_ACCURACY_GPS:
+        if acc > MIN_ACCURACY_GPS:
             return False
         
         # Manage invalid alttiude accuracy
-        if newLocation.altacc > 32000:
-            location.altacc = 0
+        if self.fixes.altacc[index] > 32000:
+            self.fixes.altacc[index] = 0
 
-        # Try at least three times to get a "type 3 fix"
+        # Stop as soon as the fused estimate is good enough, or else
+        # try at least three times to get a "type 3 fix"
         self.fix_tries += 1
+        if self.filter.accuracy() <= FUSION_ACCURACY:
+            metrics.observe("gps.tries", self.fix_tries)
+            self.fix_tries = 0
+            return True
         if mode < 3 and self.fix_tries < 3:
             return False
+        metrics.observe("gps.tries", self.fix_tries)
         self.fix_tries = 0        
         return True
-    def processGSM(self, mode, newLocation):
+    def processAny(self, index):
+        # We don't know the method, so judge by the accuracy
+        if self.fixes.acc[index] <= MIN_ACCURACY_GPS:
+            return self.processGPS(index)
+        else:
+            return self.processGSM(index)
+    def processGSM(self, index):
         # Ignore cached or country-size measurements
-        # TODO: howto detect MMC lookups? mode seems 2 either way
-        if mode < 2:
+        if self.fixes.mode[index] < 2:
             return False
             
         # I don't care about data of very low accuracy
-        if newLocation.acc > MIN_ACCURACY_GSM:
+        if self.fixes.acc[index] > MIN_ACCURACY_GSM:
             return False
         
+        # The mode is 2 for MCC lookups as well, which lie somewhere in the
+        # middle of the country instead of near the serving cell
+        known = self.cells.get(self.cells.current())
+        if known is not None:
+            lat, lng, acc = known
+            if distance(lat, lng, self.fixes.lat[index], self.fixes.lng[index]) > max(CELL_MCC_DISTANCE, acc + self.fixes.acc[index]):
+                self.logger.debug("Rejecting what looks like an MCC fix")
+                return False
+        
         return True
     
     # Actions
@@ -371,62 +2015,513 @@ class GPSWrapper(gobject.GObject):
         self.owned = True
         self.source = source
         self.aid = aid
+        self.lookup_time = clock.time()
         
-        if (source == self.Source.GSM):
+        if (source == self.Source.GSM and self.session.standby):
+            # The GPS is still running, which beats a cell lookup
+            self.logger.debug("Using the GPS on standby instead")
+            self.source = self.Source.GPS
+            self.session.acquire(self.location.METHOD_GNSS)
+            self._resume()
+        elif (source == self.Source.GSM):
+            # We might know the serving cell already
+            if self._cachedCell():
+                return
+            
             if (aid == self.Aid.INTERNET):
-                self.control.set_properties(preferred_method = location.METHOD_ACWP)
+                self.control.set_properties(preferred_method = self.location.METHOD_ACWP)
             else:
-                self.control.set_properties(preferred_method = location.METHOD_CWP)
-            self.control.start()
+                self.control.set_properties(preferred_method = self.location.METHOD_CWP)
+            self._startControl()
         elif (source == self.Source.GPS):
             if (aid == self.Aid.INTERNET):
-                self.control.set_properties(preferred_method = location.METHOD_AGNSS)
+                method = self.location.METHOD_AGNSS
             else:
-                self.control.set_properties(preferred_method = location.METHOD_GNSS)
-            self.control.start()
-        elif (source == self.Source.WIFI):
-            addresses = self._getWIFI()
-            emits = 0
-            if (aid == self.Aid.INTERNET):
-                for address in addresses:
-                    skyhook = Skyhook(address)
-                    try:
-                        result = skyhook.getLocation()
-                        newLocation = Location()
-                        newLocation.lat = result["Latitude"]
-                        newLocation.lng = result["Longitude"]
-                        newLocation.accuracy = 10
-                        self.emit("fix", newLocation)
-                        emits = emits + 1
-                    except Exception, err:
-                        self.logger.error("Could not lookup over WIFI: %s", str(err))
-                        pass
+                method = self.location.METHOD_GNSS
+            if self.session.acquire(method):
+                self._resume()
             else:
-                self.logger.error("Offline WIFI lookup not implemented yet")
-                # TODO: implement this
-            if emits == 0:
-                self.emit("nofix")
-                
+                self._startControl()
+        elif (source == self.Source.WIFI):
+            self.lookup += 1
+            lookup = self.lookup
+            self._getWIFI(lambda accesspoints: self.onScan(lookup, accesspoints))
+    def race(self, aid):
+        # Start all sources at once
+        self.owned = True
+        self.source = self.Source.RACE
+        self.aid = aid
+        self.lookup_time = clock.time()
+        self.race_time = clock.time()
+        
+        if (aid == self.Aid.INTERNET):
+            method = self.location.METHOD_ACWP | self.location.METHOD_AGNSS
+        else:
+            method = self.location.METHOD_CWP | self.location.METHOD_GNSS
+        if self.session.acquire(method):
+            self._resume()
+        else:
+            self._startControl()
+        
+        self.lookup += 1
+        lookup = self.lookup
+        self._getWIFI(lambda accesspoints: self.onScan(lookup, accesspoints))
+        
+        # The cell cache can answer right away
+        if self.owned:
+            self._cachedCell()
     def stop(self):
         self.owned = False
+        self.lookup += 1    # abandon pending lookups
+        self.lookup_time = None
         
         if (self.source == self.Source.GSM):
-            self.control.stop()
-        if (self.source == self.Source.GPS):
-            self.control.stop()
+            self._stopControl()
+        if (self.source in (self.Source.GPS, self.Source.RACE) and self.control_time is not None):
+            # Keep the GPS around if we're moving, as far as we still know
+            fixed = self.fixes.time[self.latest] if self.latest is not None else 0
+            speed = self._speed() if clock.time() - fixed <= GPS_STANDBY_INTERVAL else None
+            if self.session.release(speed, fixed):
+                self._stopControl()
+    def release(self):
+        # Stop the GPS if we kept it on standby
+        if self.session.standby:
+            self._stopControl()
+    def save(self):
+        # Write out whatever we learned
+        self.index.flush()
+        if self.places.timeout is not None:
+            self.places.save()
+        if self.cells.timeout is not None:
+            self.cells.save()
+    def conserveMemory(self, low):
+        # Trade memory for lookups while memory is low
+        if low:
+            index = self.fixes.resize(MEMORY_LOW_FIXES)
+            Skyhook.cache.resize(MEMORY_LOW_RESULTS)
+            Skyhook.pool.clear()
+            self.index.flush()
+        else:
+            index = self.fixes.resize(FIX_BUFFER_SIZE)
+            Skyhook.cache.resize(SKYHOOK_CACHE_SIZE)
+        self.latest = index if index >= 0 else None
+    
+    # Auxiliary
+    def _getWIFI(self, callback):
+        metrics.count("wifi.scans")
+        self.scanner.scan(callback)
+    def _fuse(self, newLocation):
+        self.filter.update(newLocation.lat, newLocation.lng, newLocation.acc,
+                           newLocation.speed, newLocation.head, newLocation.time)
+        self.filter.attach(newLocation)
+    def _noWIFI(self):
+        # In a race, the other sources might still come through
+        if self.source == self.Source.WIFI:
+            self.emit("nofix")
+    def _emitFix(self, newLocation, source):
+        # In a race, each source has to stay within its budget
+        if self.owned and self.source == self.Source.RACE:
+            accuracy, seconds = RACE_BUDGET[self.kinds[source]]
+            if newLocation.acc > accuracy or clock.time() - self.race_time > seconds:
+                self.logger.debug("Ignoring a %s fix outside of its budget", source)
+                return
+        
+        # Time to the first acceptable fix of a lookup, per source
+        if self.owned and self.lookup_time is not None:
+            metrics.observe("fix.%s.seconds" % source, clock.time() - self.lookup_time)
+            self.lookup_time = None
+        metrics.count("fix.%s" % source)
+        newLocation.source = source
+        self.emit("fix", newLocation)
+    def _startControl(self):
+        self.control_time = clock.time()
+        self.control_source = self.source
+        self.control.start()
+    def _stopControl(self):
+        # Keep track of how long we kept the receiver powered
+        if self.control_time is not None:
+            metrics.count("control.%s.seconds" % self.sources[self.control_source], clock.time() - self.control_time)
+        self.control_time = None
+        self.session.stop()
+        self.control.stop()
+    def _cachedCell(self):
+        # Returns whether we could answer from the cell cache
+        known = self.cells.get(self.cells.current())
+        if known is None:
+            return False
+        self.logger.debug("Found the serving cell in the cache")
+        newLocation = Location()
+        newLocation.time = clock.time()
+        newLocation.lat, newLocation.lng, newLocation.acc = known
+        self._fuse(newLocation)
+        self._emitFix(newLocation, "cell")
+        return True
+    def _speed(self):
+        # In m/s, as measured by the GPS if it did
+        if self.latest is not None:
+            speed = self.fixes.speed[self.latest]
+            if speed == speed and clock.time() - self.fixes.time[self.latest] <= GPS_FRESH:
+                return speed / 3.6  # km/h
+        return self.filter.speed()
+    def _resume(self):
+        # Coming out of standby, the latest fix might do already
+        self.logger.debug("Resuming the GPS from standby")
+        if self.latest is not None and clock.time() - self.fixes.time[self.latest] <= GPS_FRESH:
+            self._process(self.latest)
+
+class TrackSimplifier:
+    # Member data
+    logger = logging.getLogger('TrackSimplifier')
+    
+    # Actions
+    def simplify(self, entries):
+        # Opening-window simplification: grow a segment from the last kept
+        # point for as long as all points in between lie close to it
+        if len(entries) <= 2:
+            return list(entries)
+        kept = [entries[0]]
+        anchor = 0
+        for i in range(1, len(entries)-1):
+            if not self._redundant(entries, anchor, i):
+                kept.append(entries[i])
+                anchor = i
+        kept.append(entries[-1])
+        return kept
+    
+    # Auxiliary
+    def _redundant(self, entries, anchor, i):
+        start = entries[anchor]
+        entry = entries[i]
+        
+        # A coarse point can't vouch for more accurate ones
+        if start.acc > max(TRACK_TOLERANCE, entry.acc):
+            return False
+        
+        # Standing still within the accuracy of both points
+        if distance(start.lat, start.lng, entry.lat, entry.lng) <= min(start.acc, entry.acc):
+            return True
+        
+        # Changing heading
+        if entry.speed > 0 and start.speed > 0 and \
+                abs((entry.head - start.head + 180) % 360 - 180) > UPDATE_TURN:
+            return False
+        
+        # Lying on the line towards the next point
+        end = entries[i+1]
+        for k in range(anchor+1, i+1):
+            if self._offset(start, end, entries[k]) > max(TRACK_TOLERANCE, entries[k].acc):
+                return False
+        return True
+    def _offset(self, start, end, point):
+        # Distance from a point to a segment, in a local flat projection
+        scale = math.cos(math.radians(start.lat))
+        def project(entry):
+            return (math.radians(entry.lng - start.lng) * scale * 6371000,
+                    math.radians(entry.lat - start.lat) * 6371000)
+        (x2, y2), (x, y) = project(end), project(point)
+        length = x2*x2 + y2*y2
+        if length == 0:
+            return math.sqrt(x*x + y*y)
+        t = min(1, max(0, (x*x2 + y*y2) / length))
+        return math.sqrt((x - t*x2)**2 + (y - t*y2)**2)
+
+class UploadPolicy:
+    # Member data
+    logger = logging.getLogger('UploadPolicy')
+    saved = 0
+    forced = 0
+    
+    # Actions
+    def shouldUpload(self, entries, bearer):
+        # Piggyback on an existing connection: always over WLAN, but only
+        # bother the cellular radio when we're halfway due
+        if len(entries) == 0:
+            return False
+        if bearer is not None and bearer.startswith("WLAN"):
+            return True
+        return self._due(entries, 0.5)
+    def shouldForce(self, entries, pending=0):
+        # Bring up a connection ourselves
+        return self._due(entries, 1, pending)
+    def defer(self):
+        self.saved += 1
+        self.logger.info("Deferring upload (saved %d out of %d connections)", self.saved, self.saved + self.forced)
     
     # Auxiliary
-    def _getWIFI(self):
-        proc = subprocess.Popen('iwlist scan 2>/dev/null', shell=True, stdout=subprocess.PIPE, )
-        stdout_str = proc.communicate()[0]
-        stdout_list=stdout_str.split('\n')
-        address=[]
-        for line in stdout_list:
-            line=line.strip()
-            match=re.search('Address: (\S+)',line)
-            if match:
-                address.append(match.group(1)) 
-        return address
+    def _due(self, entries, factor, pending=0):
+        if len(entries) + pending == 0:
+            return False
+        if len(entries) + pending >= UPLOAD_MIN_ENTRIES * factor:
+            return True
+        oldest = clock.time()
+        if len(entries) > 0:
+            oldest = entries[0].time
+        return clock.time() - oldest >= UPLOAD_MAX_AGE * 60 * factor
+
+class Scheduler:
+    # Member data
+    logger = logging.getLogger('Scheduler')
+    timeout = None
+    last = None
+    inactive = False
+    delay = UPDATE_AT_MOST * 60
+    
+    # Constructor
+    def __init__(self, callback):
+        self.callback = callback
+    
+    # Events
+    def onTimeout(self):
+        self.timeout = None
+        self.callback()
+        return False
+    
+    # Actions
+    def schedule(self, location):
+        # Pick the next update based on how we moved since the previous one
+        self.delay = self._nextDelay(location)
+        self.logger.info("Next update in %d seconds", self.delay)
+        self.defer(self.delay)
+        if location is not None:
+            self.last = location
+    def defer(self, delay):
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = clock.timeout_add(int(delay * 1000), self.onTimeout)
+    
+    # Auxiliary
+    def _nextDelay(self, location):
+        delay = self.delay
+        if location is None or self.last is None or location is self.last:
+            # Nothing new, so we probably didn't move
+            delay = delay * UPDATE_BACKOFF
+        else:
+            moved = distance(self.last.lat, self.last.lng, location.lat, location.lng)
+            elapsed = max(1, location.time - self.last.time)
+            if location.speed > 0:
+                speed = location.speed / 3.6    # km/h
+            else:
+                speed = moved / elapsed
+            
+            if moved < max(UPDATE_STILL, location.acc, self.last.acc):
+                delay = delay * UPDATE_BACKOFF
+            elif self.last.speed > 0 and location.speed > 0 and \
+                    abs((location.head - self.last.head + 180) % 360 - 180) > UPDATE_TURN:
+                delay = 0
+            else:
+                delay = UPDATE_DISTANCE / max(speed, 0.1)
+        if self.inactive:
+            return min(max(delay, UPDATE_INACTIVE * 60), UPDATE_AT_LEAST * 60)
+        return min(max(delay, UPDATE_AT_MOST * 60), UPDATE_AT_LEAST * 60)
+
+class Sink:
+    # An account we upload to, with its own queue and upload policy
+    
+    # Member data
+    logger = logging.getLogger('Sink')
+    uploading = False
+    upload_time = 0
+    failures = 0
+    retry_time = 0
+    retry = None
+    breaker_time = 0
+    published = None
+    republish = False
+    
+    # Constructor
+    def __init__(self, account, service):
+        self.account = account
+        self.service = service
+        self.policy = UploadPolicy()
+        self.simplifier = TrackSimplifier()
+        self.uploaded = LRUCache(UPLOAD_DEDUP_SIZE, UPLOAD_DEDUP_TTL)
+        
+        # Restore the cache
+        self.journal = Journal(accountFile(JOURNAL_FILE, account))
+        self.cache = self.journal.replay()
+        if len(self.cache) > CACHE_MAX_ENTRIES:
+            del self.cache[:-CACHE_MAX_ENTRIES]
+            self.journal.compact(self.cache)
+    
+    # Events
+    def onUploaded(self, entries, accepted, rejected):
+        self.uploading = False
+        self.logger.info("Uploaded %d out of %d entries", len(accepted), len(entries))
+        metrics.observe("upload.seconds", clock.time() - self.upload_time)
+        metrics.observe("upload.batch", len(entries))
+        metrics.count("upload.accepted", len(accepted))
+        metrics.count("upload.rejected", len(rejected))
+        
+        # Drop what the server accepted, or never will
+        for entry in accepted:
+            self.uploaded.put(entry.getTimestamp(), True)
+        for entry in accepted + rejected:
+            if entry in self.cache:
+                self.cache.remove(entry)
+        if len(accepted) + len(rejected) > 0:
+            self.journal.compact(self.cache)
+        if self.published in rejected:
+            self.published = None
+        
+        # Back off if nothing got through
+        if len(accepted) == 0 and len(rejected) < len(entries):
+            self.published = None   # the server doesn't have anything to supersede
+            self.republish = False
+            self._backoff()
+        else:
+            self.failures = 0
+            self.retry_time = 0
+            self.breaker_time = 0
+            
+            # Send the refinement which came in while uploading
+            if self.republish:
+                self.republish = False
+                self.push(True)
+        
+        return False
+    def onRetry(self):
+        self.retry = None
+        global connection
+        if connection.connected:
+            self.push()
+        return False
+    
+    # Actions
+    def record(self, location):
+        # Returns whether the location made it into the cache
+        if self.published is not None and location.time - self.published.time <= UPDATE_AT_MOST * 60:
+            # Only supersede a published fix if it's worth another request
+            if location.acc * PROGRESSIVE_FACTOR > self.published.acc:
+                return False
+            if location.getTimestamp() <= self.published.getTimestamp():
+                # The server keeps the latest one (but others share this fix)
+                location = copy.copy(location)
+                location.time = self.published.time + 0.001
+            self.published = None
+        if (len(self.cache) == 0):
+            self._cacheAppend(location)
+        elif (clock.time()  - self.cache[-1].time > UPDATE_AT_MOST * 60):
+            self._cacheAppend(location)
+        elif (self.cache[-1].acc > location.acc):
+            self._cacheReplace(location)
+        else:
+            return False
+        return True
+    def sync(self):
+        self.journal.sync()
+    def simplify(self):
+        # Drop redundant entries (but not the latest, which might still get replaced)
+        entries = self.simplifier.simplify(self.cache[:-1]) + self.cache[-1:]
+        if len(entries) < len(self.cache):
+            self.logger.info("Dropping %d redundant entries", len(self.cache) - len(entries))
+            self.cache[:] = entries
+            self.journal.compact(self.cache)
+    def enqueue(self, locations):
+        # Queue entries in bulk (eg. imported ones)
+        for location in locations:
+            self.cache.append(location)
+        self.cache.sort(key=lambda entry: entry.time)
+        if len(self.cache) > CACHE_MAX_ENTRIES:
+            self.logger.warning("Cache is full, dropping the oldest %d entries", len(self.cache) - CACHE_MAX_ENTRIES)
+            del self.cache[:-CACHE_MAX_ENTRIES]
+        self.journal.compact(self.cache)
+    def publish(self):
+        # Upload the latest entry right away, superseding what we published before
+        if len(self.cache) == 0 or clock.time() < self.retry_time:
+            return False
+        self.published = self.cache[-1]
+        if self.uploading:
+            self.republish = True
+        else:
+            self.push(True)
+        return True
+    def shouldForce(self, pending=0):
+        # Don't bring up connections while the service seems to be down
+        if clock.time() < self.breaker_time:
+            return False
+        return self.policy.shouldForce(self.cache, pending)
+    def flush(self, bearer):
+        # Upload over the current connection if the policy allows
+        if self.policy.shouldUpload(self.cache, bearer) or self.policy.shouldForce(self.cache):
+            self.push()
+        else:
+            self.policy.defer()
+    def push(self, everything=False):
+        # If a lookup is still going on, don't push the latest entry (can still get updated)
+        global gps
+        keep_entries = 0
+        if (gps.owned and not everything):
+            keep_entries = 1
+        
+        # Don't start a second upload while the previous one is in flight
+        if self.uploading:
+            self.logger.debug("Upload still in progress")
+            return False
+        if clock.time() < self.retry_time:
+            self.logger.debug("Backing off after a failed upload")
+            return False
+        
+        self._dedup()
+        if (len(self.cache) > keep_entries):
+            # Don't bother uploading redundant points
+            pending = self.cache[:len(self.cache)-keep_entries]
+            entries = self.simplifier.simplify(pending)
+            if len(entries) < len(pending):
+                self.logger.info("Dropping %d redundant entries", len(pending) - len(entries))
+                self.cache[:len(pending)] = entries
+                self.journal.compact(self.cache)
+            
+            self.logger.info("Uploading entries")
+            self.uploading = True
+            self.upload_time = clock.time()
+            self.service.uploadAsync(self.cache[:len(self.cache)-keep_entries], self.onUploaded)
+        
+        return False
+    
+    # Auxiliary
+    def _cacheAppend(self, location):
+        self.cache.append(location)
+        self.journal.append(location)
+        
+        # Evict the oldest entries, but only rewrite the journal once in a while
+        if len(self.cache) > CACHE_MAX_ENTRIES:
+            self.logger.warning("Cache is full, dropping the oldest entry")
+            del self.cache[0]
+            if self.journal.records > 2 * CACHE_MAX_ENTRIES:
+                self.journal.compact(self.cache)
+    def _cacheReplace(self, location):
+        self.cache[-1] = location
+        self.journal.replace(location)
+    def _dedup(self):
+        # Don't send entries again we uploaded earlier on (eg. imported twice); this
+        # is only remembered in memory, after a restart the server answers 409 instead
+        seen = set()
+        unique = []
+        for entry in self.cache:
+            key = entry.getTimestamp()
+            if key in seen or self.uploaded.get(key) is not None:
+                continue
+            seen.add(key)
+            unique.append(entry)
+        if len(unique) < len(self.cache):
+            self.logger.info("Dropping %d duplicate entries", len(self.cache) - len(unique))
+            self.cache[:] = unique
+            self.journal.compact(self.cache)
+    def _backoff(self):
+        self.failures += 1
+        metrics.count("upload.failures")
+        delay = backoff(self.failures - 1, UPLOAD_BACKOFF, UPLOAD_BACKOFF_MAX)
+        self.retry_time = clock.time() + delay
+        self.logger.info("Retrying the upload in %d seconds", delay)
+        if self.retry is not None:
+            clock.source_remove(self.retry)
+        self.retry = clock.timeout_add(int(delay * 1000), self.onRetry)
+        
+        # Trip the circuit breaker after too many failures in a row
+        if self.failures >= UPLOAD_BREAKER:
+            self.logger.warning("Latitude seems to be down, not connecting for it during %d minutes", UPLOAD_BREAKER_TIME)
+            metrics.count("upload.breaker")
+            self.breaker_time = clock.time() + UPLOAD_BREAKER_TIME * 60
 
 class Actor:
     # Auxiliary
@@ -436,15 +2531,35 @@ class Actor:
         UPDATING_GSM = 2
         UPDATING_GPS = 3
         CONNECTING = 4
+        PUSHING = 5
+        RACING = 6
     
     # Member data
     logger = logging.getLogger('Actor')
-    cache = []
+    states = dict((value, name.lower()) for (name, value) in vars(State).items() if name.isupper())
     state = State.IDLE
+    state_time = 0
     timeout = None
+    last = None
+    passive_time = 0
+    aid = GPSWrapper.Aid.INTERNET
+    racing = False
+    refining = False
+    progressive = False
+    publications = 0
+    lazy = False
+    place = None
+    place_time = 0
+    recorded = None
+    task = None
     
     # Constructor
-    def __init__(self):        
+    def __init__(self, sinks):        
+        self.state_time = clock.time()
+        self.scheduler = Scheduler(self.update)
+        self.sinks = sinks
+        self.history = History(HISTORY_DIR)
+        
         # Listen for GPS events
         global gps
         gps.connect("fix", self.onFix)
@@ -453,17 +2568,38 @@ class Actor:
         # Listen for connection events
         global connection
         connection.connect("connected", self.onConnected)
+        
+        # Listen for device events
+        global device
+        device.connect("shutdown", self.onShutdown)
+        device.connect("save", self.onSave)
+        device.connect("memory", self.onMemory)
+        device.connect("inactivity", self.onInactivity)
     
     # Events
     def onFix(self, gps, location):
-        # Fill the cache
-        if (len(self.cache) == 0):
-            self.cache.append(location)
-        elif (time.time()  - self.cache[-1].time > UPDATE_AT_MOST * 60):
-            self.cache.append(location)
-        elif (self.cache[-1].acc > location.acc):
-            self.cache[-1] = location
-        else:
+        self.last = location
+        
+        # Passive fixes can come in every second, so thin them out
+        if self.recorded is None or location.time - self.recorded.time >= HISTORY_INTERVAL or \
+                location.acc < self.recorded.acc:
+            if self.history.record(location):
+                self.recorded = location
+        if not gps.owned:
+            self.passive_time = location.time
+        
+        # At a known place, only update when arriving or once in a while
+        if location.place is not None and location.place == self.place:
+            if location.time - self.place_time < PLACE_UPDATE * 60:
+                self.logger.info("Still at a known place")
+                self._success()
+                return
+        self.place = location.place
+        self.place_time = location.time
+        
+        # Fill the caches
+        recorded = [sink.record(location) for sink in self.sinks]
+        if not any(recorded):
             return  # TODO: this can break cell update. always schedule timeout?
         
         self._success()
@@ -473,8 +2609,50 @@ class Actor:
         return False
     def onConnected(self, connection):
         self.logger.debug("Device is now connected")
-        self._success()
-    
+        if self.state in (self.State.CONNECTING, self.State.PUSHING):
+            self._success()
+        else:
+            # Someone else brought up a connection
+            for sink in self.sinks:
+                if sink.policy.shouldUpload(sink.cache, connection.bearer):
+                    self.logger.info("Uploading over an existing connection")
+                    sink.push()
+    def onShutdown(self, device):
+        self.logger.info("Device is shutting down")
+        global gps
+        gps.stop()
+        gps.release()
+        self._save()
+    def onSave(self, device):
+        self.logger.info("Saving data")
+        self._save()
+    def onMemory(self, device, low):
+        global gps
+        if low:
+            self.logger.warning("Memory is low, shrinking caches")
+            for sink in self.sinks:
+                sink.simplify()
+            self._save()
+        else:
+            self.logger.info("Memory is no longer low")
+        gps.conserveMemory(low)
+    def onInactivity(self, device, inactive):
+        global gps
+        self.scheduler.inactive = inactive
+        if inactive:
+            self.logger.info("Device is inactive, updating less often")
+            gps.release()
+        else:
+            self.logger.info("Device is active again")
+    def onDeadline(self, task):
+        if task is not self.task:
+            return
+        global gps
+        gps.stop()
+        if self.timeout != None:
+            clock.source_remove(self.timeout)
+        self.timeout = None
+        self._idle()
     # Update method
     def updateFirst(self):
         self.update()
@@ -482,108 +2660,251 @@ class Actor:
     def update(self):
         self.logger.info("Updating the location")
         
-        global connection
-        self.state = self.State.CONNECTING
-        if not connection.connected:
-            self.logger.info("Connecting")
-            connection.request()
-            self.timeout = gobject.timeout_add(TIMEOUT_CONN * 1000, self._timeout)
+        # Make sure we never go stale, even if this update gets stuck
+        self.scheduler.defer(UPDATE_AT_LEAST * 60)
+        if self.task is not None:
+            self.task.cancel()
+        self.task = Task("update", TIMEOUT_UPDATE, self.onDeadline)
+        
+        # In passive mode, only look up ourselves when other applications didn't
+        global gps, connection
+        if gps.passive and clock.time() - self.passive_time < UPDATE_AT_LEAST * 60:
+            self.logger.info("Using passive fixes")
+            self._flush()
+        elif connection.connected:
+            self._lookup(GPSWrapper.Aid.INTERNET)
+        elif any(sink.shouldForce(1) for sink in self.sinks):
+            # We'll need a connection anyway, so get one to aid the lookup
+            self._connect(self.State.CONNECTING)
         else:
-            self._success()
+            self._lookup(GPSWrapper.Aid.NONE)
         
         return True
     
     # Auxiliary
     def pushCache(self):
-        # If the GPS is still running, don't push the latest entry (can still get updated)
-        global gps
-        keep_entries = 0
-        if (gps.running):
-            keep_entries = 1
-        
-        if (len(self.cache) > keep_entries):
-            self.logger.info("Uploading entries")
-            global service
-            service.upload(self.cache[keep_entries:])
-            del self.cache[keep_entries:]
-        
+        for sink in self.sinks:
+            sink.push()
         return False
     
+    def _save(self):
+        # Flush everything to disk
+        global gps
+        for sink in self.sinks:
+            sink.sync()
+        self.history.sync()
+        gps.save()
+        if metrics.filename is not None:
+            metrics.save()
+    
     # State machine
+    def _lookup(self, aid):
+        global gps
+        self.aid = aid
+        if self.lazy and self.last is None and gps.cells.get(gps.cells.current()) is not None:
+            # Right after starting, answer from the cell cache instead of waiting for a scan
+            self.logger.info("Attempting cached GSM lookup")
+            self._enter(self.State.UPDATING_GSM)
+            self.timeout = clock.timeout_add(TIMEOUT_GSM * 1000, self._timeout)
+            gps.start(GPSWrapper.Source.GSM, aid)
+        elif self.racing:
+            self.logger.info("Racing all sources")
+            self._enter(self.State.RACING)
+            self.refining = False
+            self.publications = 0
+            
+            # The race is over when the slowest source ran out of time
+            budget = max(seconds for (accuracy, seconds) in RACE_BUDGET.values())
+            self.timeout = clock.timeout_add(budget * 1000, self._timeout)
+            gps.race(aid)
+        else:
+            self.logger.info("Attempting WIFI lookup")
+            self._enter(self.State.UPDATING_WIFI)
+            gps.start(GPSWrapper.Source.WIFI, aid)
+    def _connect(self, state):
+        global connection
+        self.logger.info("Connecting")
+        for sink in self.sinks:
+            sink.policy.forced += 1
+        self._enter(state)
+        connection.request()
+        self.timeout = clock.timeout_add(TIMEOUT_CONN * 1000, self._timeout)
+    def _flush(self):
+        # Upload the cache if the policy allows
+        global connection
+        if connection.connected:
+            for sink in self.sinks:
+                sink.flush(connection.bearer)
+            self._idle()
+        elif any(sink.shouldForce() for sink in self.sinks):
+            self._connect(self.State.PUSHING)
+        else:
+            for sink in self.sinks:
+                if len(sink.cache) > 0:
+                    sink.policy.defer()
+            self._idle()
+    def _publish(self):
+        # Publish the first fix of a race right away, followed by a bounded number of refinements
+        global connection
+        if not self.progressive or not connection.connected or self.publications > PROGRESSIVE_EXTRA:
+            return
+        published = False
+        for sink in self.sinks:
+            if len(sink.cache) > 0 and sink.cache[-1].time >= self.last.time and sink.publish():
+                published = True
+        if published:
+            self.logger.info("Published a fix with an accuracy of %d", self.last.acc)
+            metrics.count("upload.progressive")
+            self.publications += 1
+    def _enter(self, state):
+        now = clock.time()
+        metrics.observe("actor.%s.seconds" % self.states[self.state], now - self.state_time)
+        self.state = state
+        self.state_time = now
+    def _idle(self):
+        if self.task is not None:
+            self.task.finish()
+            metrics.observe("actor.update.seconds", clock.time() - self.task.started)
+        self.task = None
+        self._enter(self.State.IDLE)
+        self.scheduler.schedule(self.last)
+        metrics.flush()
     def _failure(self):
         global gps, connection
         
         if self.state == self.State.CONNECTING:
+            self.logger.info("Failed to connect, looking up offline")
+            self._lookup(GPSWrapper.Aid.NONE)
+        elif self.state == self.State.PUSHING:
             self.logger.info("Failed to connect")
-            self.state = self.State.IDLE
+            self._idle()
         elif self.state == self.State.UPDATING_WIFI:
             self.logger.info("WIFI lookup failed")
             gps.stop()
             
             self.logger.info("Attempting GSM lookup")
-            self.state = self.State.UPDATING_GSM
-            gps.start(GPSWrapper.Source.GSM, GPSWrapper.Aid.INTERNET)
-            self.timeout = gobject.timeout_add(TIMEOUT_GSM * 1000, self._timeout)
+            self._enter(self.State.UPDATING_GSM)
+            self.timeout = clock.timeout_add(TIMEOUT_GSM * 1000, self._timeout)
+            gps.start(GPSWrapper.Source.GSM, self.aid)
         elif self.state == self.State.UPDATING_GSM:
             self.logger.info("GSM lookup failed")
             gps.stop()
             
             self.logger.info("Attempting GPS lookup")
-            self.state = self.State.UPDATING_GPS
-            gps.start(GPSWrapper.Source.GPS, GPSWrapper.Aid.INTERNET)
-            self.timeout = gobject.timeout_add(TIMEOUT_GPS * 1000, self._timeout)
+            self._enter(self.State.UPDATING_GPS)
+            self.timeout = clock.timeout_add(TIMEOUT_GPS * 1000, self._timeout)
+            gps.start(GPSWrapper.Source.GPS, self.aid)
         elif self.state == self.State.UPDATING_GPS:
             self.logger.info("GPS lookup failed")
             gps.stop()
-            self.state = self.State.IDLE
+            self._flush()
+        elif self.state == self.State.RACING:
+            # Push whatever we got
+            self.logger.info("Race is over")
+            gps.stop()
+            self.timeout = None
+            self._flush()
     def _success(self):
         global gps, connection
         
+        if self.state == self.State.RACING:
+            self._publish()
+            if self.refining or self.last.acc > RACE_ACCURACY:
+                return
+            self.logger.info("Race won with an accuracy of %d", self.last.acc)
+            clock.source_remove(self.timeout)
+            if RACE_REFINE > 0:
+                self.refining = True
+                self.timeout = clock.timeout_add(RACE_REFINE * 1000, self._timeout)
+            else:
+                self.timeout = None
+                self._failure()
+            return
+        
         if self.state == self.State.CONNECTING:
             self.logger.info("Successfully connected")
             if self.timeout != None:
-                gobject.source_remove(self.timeout)
+                clock.source_remove(self.timeout)
             self.timeout = None
             
-            self.logger.info("Attempting WIFI lookup")
-            self.state = self.State.UPDATING_WIFI
-            gps.start(GPSWrapper.Source.WIFI, GPSWrapper.Aid.INTERNET)
+            self._lookup(GPSWrapper.Aid.INTERNET)
+        elif self.state == self.State.PUSHING:
+            self.logger.info("Successfully connected")
+            if self.timeout != None:
+                clock.source_remove(self.timeout)
+            self.timeout = None
+            
+            self.pushCache()
+            
+            self._idle()
         elif self.state == self.State.UPDATING_WIFI:
             self.logger.info("WIFI lookup succeeded")
             gps.stop()
             
-            self.pushCache()
-            
-            self.state = self.State.IDLE
+            self._flush()
         elif self.state == self.State.UPDATING_GSM:
             self.logger.info("GSM lookup succeeded")
             gps.stop()
             if self.timeout != None:
-                gobject.source_remove(self.timeout)
+                clock.source_remove(self.timeout)
             self.timeout = None
             
-            self.pushCache()
-            
-            self.state = self.State.IDLE
+            self._flush()
         elif self.state == self.State.UPDATING_GPS:
             self.logger.info("GPS lookup succeeded")
             gps.stop()
             if self.timeout != None:
-                gobject.source_remove(self.timeout)
+                clock.source_remove(self.timeout)
             self.timeout = None
             
-            self.pushCache()
-            
-            self.state = self.State.IDLE
+            self._flush()
     def _timeout(self):
         self.logger.info("Timeout hit")
         self._failure()
 
+class DeviceBackend:
+    # The hardware and services used on the device itself
+    def __init__(self):
+        import location    # python-location
+        import conic
+        import osso
+        import dbus        # python-dbus
+        import dbus.mainloop.glib
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)     # deliver signals on our main loop
+        self.location = location
+        self.conic = conic
+        self.osso = osso
+        self.dbus = dbus
+        self.clock = Clock()
+    
+    # Factories
+    def scanner(self, interface):
+        return WIFIScanner(interface)
+    def skyhook(self, accesspoints):
+        return Skyhook(accesspoints)
+    def service(self, account):
+        return ServiceWrapper(account)
+
 #
 # Application handling
 #
 
-def init():    
+def init(args, hal=None):    
+    # Select the hardware
+    global backend, clock
+    if hal is None:
+        hal = DeviceBackend()
+    backend = hal
+    clock = backend.clock
+    
+    # Blocking I/O happens in worker threads
+    gobject.threads_init()
+    global pool
+    pool = WorkerPool(max(WORKERS, len(args.account) + 1))  # all accounts can upload at once
+    if args.watchdog:
+        global watchdog
+        watchdog = Watchdog(LOOP_BUDGET)
+    
     # Configure the device wrapper
     global device
     device = DeviceWrapper()
@@ -591,22 +2912,114 @@ def init():
     # Configure the GPS wrapper
     global gps
     gps = GPSWrapper()
+    gps.passive = args.passive
     
     # Configure the connection wrapper
     global connection
     connection = ConnectionWrapper()
     
-    # Configure the service wrapper
-    global service
-    service = ServiceWrapper()
+    # Configure a service wrapper per account
+    sinks = []
+    for account in args.account:
+        service = backend.service(account)
+        if not args.lazy:
+            service.connectAsync()
+        sinks.append(Sink(account, service))
     
     # Install the actor
     global actor
-    actor = Actor()
+    actor = Actor(sinks)
+    actor.racing = args.race or args.progressive
+    actor.progressive = args.progressive
+    actor.lazy = args.lazy
     
-    # Schedule updates
-    gobject.timeout_add(UPDATE_AT_LEAST * 60000, actor.update)
-    gobject.idle_add(actor.updateFirst)
+    # Export what we've been doing
+    metrics.export(STATS_FILE, STATS_SAVE)
+    
+    # Schedule updates (the actor reschedules itself after each update)
+    clock.idle_add(actor.updateFirst)
+
+def parseTime(text):
+    # An ISO 8601 date or time (UTC)
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(text[:19], format))
+        except ValueError:
+            pass
+    raise ValueError("Invalid time %s" % text)
+
+def formatTime(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def exportHistory(args):
+    history = History(HISTORY_DIR)
+    start = parseTime(args.since) if args.since else None
+    end = parseTime(args.until) if args.until else None
+    stream = open(args.file, 'w') if args.file else sys.stdout
+    
+    count = 0
+    if args.format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(('time', 'latitude', 'longitude', 'accuracy', 'source'))
+        for location in history.query(start, end):
+            writer.writerow((formatTime(location.time), "%.6f" % location.lat, "%.6f" % location.lng,
+                             "%.0f" % location.acc, location.source or ''))
+            count += 1
+    else:
+        stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<gpx version="1.1" creator="efficient-latitude" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                     '<trk><trkseg>\n')
+        for location in history.query(start, end):
+            stream.write('<trkpt lat="%.6f" lon="%.6f"><time>%s</time><extensions><accuracy>%.0f</accuracy><source>%s</source></extensions></trkpt>\n' %
+                         (location.lat, location.lng, formatTime(location.time), location.acc, location.source or ''))
+            count += 1
+        stream.write('</trkseg></trk>\n</gpx>\n')
+    
+    if stream is not sys.stdout:
+        stream.close()
+    logging.getLogger().info('Exported %d locations', count)
+
+def importHistory(args):
+    # Read the locations
+    locations = []
+    if args.format == 'csv':
+        for row in csv.DictReader(open(args.file)):
+            location = Location()
+            location.time = parseTime(row['time'])
+            location.lat = float(row['latitude'])
+            location.lng = float(row['longitude'])
+            location.acc = float(row.get('accuracy') or MIN_ACCURACY_GPS)
+            location.source = row.get('source') or None
+            locations.append(location)
+    else:
+        from xml.etree import cElementTree
+        for element in cElementTree.parse(args.file).getiterator():
+            if element.tag.split('}')[-1] != 'trkpt':
+                continue
+            location = Location()
+            location.lat = float(element.get('lat'))
+            location.lng = float(element.get('lon'))
+            location.acc = MIN_ACCURACY_GPS
+            for child in element.getiterator():
+                tag = child.tag.split('}')[-1]
+                if tag == 'time':
+                    location.time = parseTime(child.text.strip())
+                elif tag == 'accuracy':
+                    location.acc = float(child.text)
+                elif tag == 'source':
+                    location.source = child.text
+            locations.append(location)
+    locations.sort(key=lambda location: location.time)
+    
+    # Add them to the history, and queue them for uploading
+    history = History(HISTORY_DIR)
+    recorded = 0
+    for location in locations:
+        if history.record(location):
+            recorded += 1
+    for account in args.account:
+        Sink(account, None).enqueue(locations)
+    logging.getLogger().info('Imported %d locations (%d into the history)', len(locations), recorded)
 
 def daemonize():
     pid = os.fork()
@@ -640,17 +3053,45 @@ def main(args):
     else:
         rootlogger.setLevel(logging.INFO)
     
-    rootlogger.info('Initializing application')
-    init()
+    # Maintenance commands
+    if args.format is None:
+        args.format = 'csv' if args.file and args.file.endswith('.csv') else 'gpx'
+    if args.command == 'export':
+        exportHistory(args)
+        return
+    elif args.command == 'import':
+        if args.file is None:
+            parser.error('import needs a file')
+        importHistory(args)
+        return
     
+    # Fork before starting any threads, as they wouldn't survive it
     if args.daemonize:
+        # Authorizing needs the terminal, which we lose by forking
+        for account in args.account:
+            ServiceWrapper(account).authorize()
         rootlogger.info('Forking into the background')
         daemonize()
+    
+    rootlogger.info('Initializing application')
+    init(args)
     gobject.MainLoop().run()
 
 
 parser = argparse.ArgumentParser(description='Intelligent Google Latitude updater.')
+parser.add_argument('command', help='what to do: update the location (the default), export the history, or import locations into the history and the upload queue (with the daemon stopped)', nargs='?', choices=['run', 'export', 'import'], default='run')
+parser.add_argument('file', help='where to export to (defaults to the standard output) or import from', nargs='?')
+parser.add_argument('--format', '-f', help='the format to export or import (defaults to the file extension, or gpx)', choices=['gpx', 'csv'])
+parser.add_argument('--since', help='only export locations since this (UTC) date or time')
+parser.add_argument('--until', help='only export locations until this (UTC) date or time')
 parser.add_argument('--verbose', '-v', help='print more information', action='store_true')
 parser.add_argument('--daemonize', '-d', help='fork in the background', action='store_true')
-main(parser.parse_args())
+parser.add_argument('--passive', '-p', help='piggyback on GPS sessions of other applications', action='store_true')
+parser.add_argument('--race', '-r', help='start all location sources at once', action='store_true')
+parser.add_argument('--progressive', '-P', help='publish the first fix of an update right away, and better ones as they come in (implies --race)', action='store_true')
+parser.add_argument('--watchdog', '-w', help='report callbacks blocking the main loop', action='store_true')
+parser.add_argument('--account', '-a', help='upload to this account as well (can be repeated)', action='append', default=[None])
+parser.add_argument('--lazy', '-l', help='start fast: connect to Latitude on the first upload, and answer the first update from the cell cache', action='store_true')
+if __name__ == '__main__':
+    main(parser.parse_args())
 
@@ -0,0 +1,752 @@
+#!/usr/bin/python
+
+################################################################################
+# Configuration
+#
+
+# System modules
+import argparse    # python-argparse
+import gobject
+import heapq
+import json
+import os
+import logging
+import tempfile
+import threading
+import time
+
+# Application
+import latitude
+
+# Definitions
+START             = 1300000000  # When the simulation starts (seconds since the epoch)
+GPS_TTFF          = 45     # How long a cold GPS start takes (seconds)
+GPS_TTFF_ASSISTED = 15     # How long an assisted GPS start takes (seconds)
+GPS_TTFF_HOT      = 3      # How long a hot GPS start takes (seconds)
+GPS_HOT           = 300    # How long after stopping the GPS it still starts hot (seconds)
+GSM_DELAY         = 3      # How long a cell lookup takes (seconds)
+MCC_ACCURACY      = 100000 # The accuracy of a country-level fix (meters)
+SCAN_DELAY        = 2      # How long a WIFI scan takes (seconds)
+CONNECT_DELAY     = 3      # How long it takes to bring up a connection (seconds)
+CONNECT_IDLE      = 30     # How long a connection we brought up stays up without traffic (seconds)
+SKYHOOK_LATENCY   = 1      # How long a Skyhook request takes (seconds)
+UPLOAD_LATENCY    = 1      # How long an upload request takes (seconds)
+BATCH_URI         = "https://www.googleapis.com/batch"
+
+# Traces are files with one JSON record per line, each having a time "t"
+# (seconds since the start of the trace) and a "type":
+#   gps:        a fix as the GPS would report it, with "lat", "lng", "acc"
+#               (meters), and optionally "alt", "speed" (km/h), "head" and
+#               "mode" (defaults to 3)
+#   cell:       the serving cell changed, with "cell" ([mcc, mnc, lac, cid])
+#               and where the network locates it ("lat", "lng", "acc")
+#   scan:       the access points now in range, with "accesspoints" (a list
+#               of {"bssid", "rssi"}), and where Skyhook locates them
+#               ("lat", "lng", "acc"; omit if unknown)
+#   coverage:   whether we can bring up a connection ("available")
+#   connection: another application (dis)connects, with "connected" and
+#               "bearer" (eg. "WLAN_INFRA" or "GPRS")
+#   service:    whether Latitude accepts uploads ("available")
+#   external:   another application starts or stops the GPS ("running")
+#   device:     a device state change, with any of "shutdown",
+#               "save_unsaved_data", "memory_low" and "system_inactivity"
+
+
+#
+# Auxiliary
+#
+
+class VirtualClock:
+    # Discrete-event replacement for the main loop, which runs as fast as possible
+
+    # Member data
+    longest = 0.0       # wall-clock time of the slowest callback (seconds)
+    culprit = None      # which callback that was
+
+    # Constructor
+    def __init__(self, start):
+        self.now = start
+        self.events = []
+        self.sources = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    # Actions
+    def time(self):
+        return self.now
+    def timeout_add(self, interval, callback, *args):
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            self.sources[self.counter] = (interval, callback, args)
+            heapq.heappush(self.events, (self.now + interval / 1000.0, self.counter))
+            return self.counter
+        finally:
+            self.lock.release()
+    def idle_add(self, callback, *args):
+        return self.timeout_add(0, callback, *args)
+    def source_remove(self, tag):
+        self.lock.acquire()
+        try:
+            return self.sources.pop(tag, None) is not None
+        finally:
+            self.lock.release()
+    def run(self, until):
+        # Process all events up to the given time
+        while True:
+            self.lock.acquire()
+            try:
+                if len(self.events) == 0 or self.events[0][0] > until:
+                    break
+                when, tag = heapq.heappop(self.events)
+                source = self.sources.get(tag)
+            finally:
+                self.lock.release()
+            if source is None:
+                continue    # removed
+
+            self.now = max(self.now, when)
+            interval, callback, args = source
+            started = time.time()
+            again = callback(*args)
+            elapsed = time.time() - started
+            if elapsed > self.longest:
+                self.longest = elapsed
+                self.culprit = self._name(callback)
+            if again and tag in self.sources:
+                self.lock.acquire()
+                heapq.heappush(self.events, (self.now + interval / 1000.0, tag))
+                self.lock.release()
+            else:
+                self.sources.pop(tag, None)
+        self.now = until
+
+    # Auxiliary
+    def _name(self, callback):
+        owner = getattr(callback, '__self__', None)
+        if owner is None:
+            return callback.__name__
+        return "%s.%s" % (owner.__class__.__name__, callback.__name__)
+
+class Statistics:
+    # What the simulated hardware and services have been through
+
+    # Constructor
+    def __init__(self):
+        self.gps_starts = 0
+        self.gps_seconds = 0.0
+        self.connections = 0
+        self.connected_seconds = 0.0
+        self.scans = 0
+        self.skyhook_requests = 0
+        self.upload_requests = 0
+        self.upload_retries = 0
+        self.uploaded_entries = 0
+        self.bytes_sent = 0
+
+    # Actions
+    def report(self, duration):
+        hours = duration / 3600.0
+        return "\n".join([
+            "Simulated %.1f hours" % hours,
+            "GPS starts:          %d" % self.gps_starts,
+            "GPS on-time:         %.0f seconds" % self.gps_seconds,
+            "Forced connections:  %d" % self.connections,
+            "Radio on-time:       %.0f seconds" % self.connected_seconds,
+            "WIFI scans:          %d" % self.scans,
+            "Skyhook requests:    %d" % self.skyhook_requests,
+            "Upload requests:     %d (%.1f per hour)" % (self.upload_requests, self.upload_requests / max(hours, 1e-9)),
+            "Upload retries:      %d" % self.upload_retries,
+            "Uploaded entries:    %d" % self.uploaded_entries,
+            "Bytes sent:          %d" % self.bytes_sent,
+            ])
+
+
+#
+# Simulated hardware
+#
+
+class SimulatedControl(gobject.GObject):
+    # Signals
+    __gsignals__ = {
+        "gpsd-running": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+        "gpsd-stopped": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+        "error-verbose": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (int, )),
+    }
+
+    # Member data
+    running = False
+    method = 0
+    interval = 0
+    started = 0
+    stopped = None
+    ready = 0
+    delivered = 0
+
+    # Constructor
+    def __init__(self, backend):
+        gobject.GObject.__init__(self)
+        self.backend = backend
+
+    # Actions
+    def set_properties(self, preferred_method=None, preferred_interval=None):
+        if preferred_method is not None:
+            self.method = preferred_method
+        if preferred_interval is not None:
+            self.interval = preferred_interval
+    def start(self):
+        if self.running:
+            return
+        clock = self.backend.clock
+        self.running = True
+        self.started = clock.time()
+
+        # Satellite fixes arrive once the receiver has warmed up
+        if self.method & (SimulatedLocation.METHOD_GNSS | SimulatedLocation.METHOD_AGNSS):
+            self.backend.statistics.gps_starts += 1
+            if self.stopped is not None and self.started - self.stopped < GPS_HOT:
+                self.ready = self.started + GPS_TTFF_HOT
+            elif self.method & SimulatedLocation.METHOD_AGNSS and self.backend.connected():
+                self.ready = self.started + GPS_TTFF_ASSISTED
+            else:
+                self.ready = self.started + GPS_TTFF
+
+        # Cell fixes arrive after a lookup
+        if self.method & (SimulatedLocation.METHOD_CWP | SimulatedLocation.METHOD_ACWP):
+            clock.timeout_add(GSM_DELAY * 1000, self.onCell, self.started)
+
+        clock.idle_add(self.onRunning)
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.stopped = self.backend.clock.time()
+        if self.method & (SimulatedLocation.METHOD_GNSS | SimulatedLocation.METHOD_AGNSS):
+            self.backend.statistics.gps_seconds += self.stopped - self.started
+        self.backend.clock.idle_add(self.onStopped)
+    def satellites(self):
+        # Whether a satellite fix is due
+        now = self.backend.clock.time()
+        if not self.running or now < self.ready or now - self.delivered < self.interval or \
+                not self.method & (SimulatedLocation.METHOD_GNSS | SimulatedLocation.METHOD_AGNSS):
+            return False
+        self.delivered = now
+        return True
+
+    # Events
+    def onRunning(self):
+        self.emit("gpsd-running")
+        return False
+    def onStopped(self):
+        self.emit("gpsd-stopped")
+        return False
+    def onCell(self, started):
+        if not self.running or self.started != started:
+            return False
+        cell = self.backend.cell
+        if cell is None:
+            return False
+        if self.method & SimulatedLocation.METHOD_ACWP and self.backend.connected():
+            self.backend.device.deliver(2, cell["lat"], cell["lng"], cell["acc"])
+        else:
+            self.backend.device.deliver(2, cell["lat"], cell["lng"], MCC_ACCURACY)
+        return False
+
+class SimulatedDevice(gobject.GObject):
+    # Signals
+    __gsignals__ = {
+        "changed": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, ()),
+    }
+
+    # Member data
+    status = 0
+    fix = (0, 0, 0, 0, 0, 0, float('nan'), 0, 0, 0, 0, 0, 0, 0, 0)
+
+    # Actions
+    def deliver(self, mode, lat, lng, acc, alt=0, head=0, speed=0):
+        # Same layout as the tuple liblocation gives us
+        self.status = SimulatedLocation.GPS_DEVICE_STATUS_FIX
+        self.fix = (mode, 0, 0, 0, lat, lng, acc * 100, alt, 0, head, 0, speed, 0, 0, 0)
+        self.emit("changed")
+    def lose(self):
+        self.status = SimulatedLocation.GPS_DEVICE_STATUS_NO_FIX
+        self.fix = (1, ) + self.fix[1:]
+        self.emit("changed")
+
+class SimulatedLocation:
+    # Stands in for the python-location module
+    METHOD_CWP = 1
+    METHOD_ACWP = 2
+    METHOD_GNSS = 4
+    METHOD_AGNSS = 8
+    GPS_DEVICE_STATUS_NO_FIX = 0
+    GPS_DEVICE_STATUS_FIX = 1
+    INTERVAL_DEFAULT = 0
+    INTERVAL_1S = 1
+    INTERVAL_2S = 2
+    INTERVAL_5S = 5
+    INTERVAL_10S = 10
+    INTERVAL_20S = 20
+    INTERVAL_30S = 30
+    INTERVAL_60S = 60
+    INTERVAL_120S = 120
+
+    # Constructor
+    def __init__(self, backend):
+        self.backend = backend
+        control = SimulatedControl(backend)
+        class GPSDControl:
+            @staticmethod
+            def get_default():
+                return control
+        self.GPSDControl = GPSDControl
+    def GPSDevice(self):
+        return self.backend.device
+
+class ConnectionEvent:
+    # Constructor
+    def __init__(self, status, bearer):
+        self.status = status
+        self.bearer = bearer
+
+    # Accessors
+    def get_status(self):
+        return self.status
+    def get_bearer_type(self):
+        return self.bearer
+
+class SimulatedConnection(gobject.GObject):
+    # Signals
+    __gsignals__ = {
+        "connection-event": (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (object, )),
+    }
+
+    # Member data
+    bearer = None
+    owned = False
+    since = 0
+    idle = None
+
+    # Constructor
+    def __init__(self, backend):
+        gobject.GObject.__init__(self)
+        self.backend = backend
+
+    # Actions
+    def set_property(self, name, value):
+        pass
+    def request_connection(self, flags):
+        if self.bearer is not None:
+            self._touch()
+            return
+        if not self.backend.coverage:
+            return
+        self.backend.statistics.connections += 1
+        self.backend.clock.timeout_add(CONNECT_DELAY * 1000, self.onConnect)
+    def change(self, connected, bearer):
+        # Another application (dis)connects
+        if connected and self.bearer is None:
+            self._up(bearer, False)
+        elif not connected and self.bearer is not None:
+            self._down()
+
+    # Events
+    def onConnect(self):
+        if self.bearer is None and self.backend.coverage:
+            self._up("GPRS", True)
+        return False
+    def onIdle(self):
+        self.idle = None
+        if self.owned:
+            self._down()
+        return False
+
+    # Auxiliary
+    def _touch(self):
+        # Connections we brought up go down once they're idle
+        if self.owned:
+            if self.idle is not None:
+                self.backend.clock.source_remove(self.idle)
+            self.idle = self.backend.clock.timeout_add(CONNECT_IDLE * 1000, self.onIdle)
+    def _up(self, bearer, owned):
+        self.bearer = bearer
+        self.owned = owned
+        self.since = self.backend.clock.time()
+        self._touch()
+        self.emit("connection-event", ConnectionEvent(SimulatedConic.STATUS_CONNECTED, bearer))
+    def _down(self):
+        if self.owned:
+            self.backend.statistics.connected_seconds += self.backend.clock.time() - self.since
+        bearer = self.bearer
+        self.bearer = None
+        self.owned = False
+        self.emit("connection-event", ConnectionEvent(SimulatedConic.STATUS_DISCONNECTED, bearer))
+
+class SimulatedConic:
+    # Stands in for the conic module
+    STATUS_CONNECTED = 0
+    STATUS_DISCONNECTED = 1
+    CONNECT_FLAG_NONE = 0
+
+    # Constructor
+    def __init__(self, backend):
+        self.connection = SimulatedConnection(backend)
+    def Connection(self):
+        return self.connection
+
+class SimulatedDeviceState:
+    # Member data
+    callback = None
+
+    # Actions
+    def set_device_state_callback(self, callback):
+        self.callback = callback
+
+class SimulatedOsso:
+    # Stands in for the osso module
+
+    # Constructor
+    def __init__(self, backend):
+        self.state = SimulatedDeviceState()
+    def Context(self, name, version, activation):
+        return None
+    def DeviceState(self, context):
+        return self.state
+
+class SimulatedNet:
+    # Constructor
+    def __init__(self, backend):
+        self.backend = backend
+        self.receivers = []
+
+    # Actions
+    def get_registration_status(self, dbus_interface=None):
+        cell = self.backend.cell
+        if cell is None:
+            return (0, 0, 0, 0, 0, 0, 0, 1)
+        mcc, mnc, lac, cid = cell["cell"]
+        return (0, lac, cid, mnc, mcc, 0, 0, 0)
+    def change(self):
+        # Emit registration_status_change, which lacks the error code
+        status = self.get_registration_status()
+        if status[-1] != 0:
+            return
+        for receiver in self.receivers:
+            receiver(*status[:-1])
+
+class SimulatedDBus:
+    # Stands in for the dbus module
+    class DBusException(Exception):
+        pass
+
+    # Constructor
+    def __init__(self, backend):
+        self.net = SimulatedNet(backend)
+    def SystemBus(self):
+        return self
+    def get_object(self, service, path, introspect=True):
+        return self.net
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, path=None):
+        self.net.receivers.append(handler)
+
+class SimulatedScanner:
+    # Member data
+    logger = logging.getLogger('SimulatedScanner')
+
+    # Constructor
+    def __init__(self, backend):
+        self.backend = backend
+
+    # Actions
+    def scan(self, callback):
+        self.backend.statistics.scans += 1
+        self.backend.clock.timeout_add(SCAN_DELAY * 1000, self.onScanned, callback)
+
+    # Events
+    def onScanned(self, callback):
+        results = []
+        for record in self.backend.scan.get("accesspoints", []):
+            accesspoint = latitude.AccessPoint()
+            accesspoint.bssid = record["bssid"]
+            accesspoint.rssi = record.get("rssi")
+            results.append(accesspoint)
+        callback(results)
+        return False
+
+
+#
+# Simulated services
+#
+
+class SimulatedResponse:
+    # Member data
+    will_close = False
+
+    # Constructor
+    def __init__(self, status, body):
+        self.status = status
+        self.reason = "OK" if status == 200 else "Error"
+        self.body = body
+    def read(self):
+        return self.body
+
+class SimulatedSkyhook(latitude.Skyhook):
+    # Constructor
+    def __init__(self, backend, accesspoints):
+        latitude.Skyhook.__init__(self, accesspoints)
+        self.backend = backend
+
+    # Actions
+    def getLocationAsync(self, callback, errback):
+        # Same as the real thing (including the cache), but answered from the trace
+        try:
+            results = self.getLocation()
+        except Exception, err:
+            self.backend.clock.timeout_add(SKYHOOK_LATENCY * 1000, self._deliver, errback, err)
+            return
+        self.backend.clock.timeout_add(SKYHOOK_LATENCY * 1000, self._deliver, callback, results)
+
+    # Auxiliary
+    def _request(self, conn):
+        if not self.backend.connected():
+            raise latitude.socket.error("Network is unreachable")
+        self.backend.statistics.skyhook_requests += 1
+        self.backend.statistics.bytes_sent += len(self.reqStr)
+        scan = self.backend.scan
+        if "lat" not in scan:
+            return SimulatedResponse(200, "<error>Unable to locate location</error>")
+        return SimulatedResponse(200, "<location><latitude>%f</latitude><longitude>%f</longitude><hpe>%d</hpe></location>" %
+            (scan["lat"], scan["lng"], scan.get("acc", latitude.WIFI_RANGE)))
+    def _deliver(self, callback, value):
+        callback(value)
+        return False
+
+class SimulatedHttpError(Exception):
+    # What apiclient raises for a failed request
+    def __init__(self, response):
+        Exception.__init__(self, "[%s %s]" % (response.status, response.reason))
+        self.resp = response
+
+class SimulatedHttp:
+    # Constructor
+    def __init__(self, service):
+        self.service = service
+        self.backend = service.backend
+
+    # Actions
+    def request(self, uri, method="GET", body=None, headers=None):
+        if not self.backend.connected():
+            raise latitude.socket.error("Network is unreachable")
+        self.backend.statistics.upload_requests += 1
+        self.backend.statistics.bytes_sent += len(body or "")
+        self.backend.conic.connection._touch()
+        self.service.elapsed += UPLOAD_LATENCY
+        if not self.backend.available:
+            return (SimulatedResponse(503, ""), "")
+        return (SimulatedResponse(200, ""), "")
+
+class SimulatedInsert:
+    # A request as built from the API description, but not executed yet
+    def __init__(self, body):
+        self.body = body
+
+class SimulatedLatitude:
+    # The API as built from its description
+    def location(self):
+        return self
+    def insert(self, body):
+        return SimulatedInsert(body)
+
+class SimulatedBatch:
+    # Sends all requests in one HTTP request, and reports on each of them
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    # Actions
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+    def execute(self, http):
+        body = "\n".join(json.dumps(request.body) for request_id, request in self.requests)
+        response, content = http.request(BATCH_URI, "POST", body=body)
+        if response.status >= 300:
+            raise SimulatedHttpError(response)
+        for request_id, request in self.requests:
+            # The server refuses a second entry with the same timestamp
+            timestamp = request.body["data"]["timestampMs"]
+            if timestamp in self.service.uploaded:
+                self.callback(request_id, None, SimulatedHttpError(SimulatedResponse(409, "")))
+                continue
+            self.service.uploaded.add(timestamp)
+            self.service.backend.statistics.uploaded_entries += 1
+            self.callback(request_id, request.body, None)
+
+class SimulatedService(latitude.ServiceWrapper):
+    # Member data
+    elapsed = 0
+
+    # Constructor
+    def __init__(self, backend, account):
+        latitude.ServiceWrapper.__init__(self, account)
+        self.backend = backend
+        self.uploaded = set()
+
+    # Actions
+    def connectAsync(self):
+        self._connect()
+    def uploadAsync(self, entries, callback):
+        # Same as the real thing (including batching and retries), but
+        # reported back after the time it would have taken
+        self.elapsed = 0
+        try:
+            accepted, rejected = self.upload(entries)
+        except Exception, err:
+            self.logger.error("Could not upload entries: %s", str(err))
+            accepted, rejected = [], []
+        self.backend.clock.timeout_add(int(self.elapsed * 1000), self._deliver, callback, entries, accepted, rejected)
+
+    # Auxiliary
+    def _authenticate(self):
+        self.http = SimulatedHttp(self)
+        self.service = SimulatedLatitude()
+    def _batch(self, callback):
+        return SimulatedBatch(self, callback)
+    def _sleep(self, seconds):
+        self.backend.statistics.upload_retries += 1
+        self.elapsed += seconds
+    def _deliver(self, callback, entries, accepted, rejected):
+        callback(entries, accepted, rejected)
+        return False
+
+
+#
+# Backend
+#
+
+class SimulatedBackend:
+    # Member data
+    logger = logging.getLogger('SimulatedBackend')
+    cell = None
+    coverage = True
+    available = True
+    external = False
+
+    # Constructor
+    def __init__(self, records):
+        self.clock = VirtualClock(START)
+        self.statistics = Statistics()
+        self.scan = {}
+        self.services = {}
+        self.device = SimulatedDevice()
+        self.location = SimulatedLocation(self)
+        self.conic = SimulatedConic(self)
+        self.osso = SimulatedOsso(self)
+        self.dbus = SimulatedDBus(self)
+
+        # Feed the trace to the main loop
+        self.duration = 0
+        for record in records:
+            self.clock.timeout_add(int(record["t"] * 1000), self.onRecord, record)
+            self.duration = max(self.duration, record["t"])
+
+    # Factories
+    def scanner(self, interface):
+        return SimulatedScanner(self)
+    def skyhook(self, accesspoints):
+        return SimulatedSkyhook(self, accesspoints)
+    def service(self, account):
+        self.services[account] = SimulatedService(self, account)
+        return self.services[account]
+
+    # Actions
+    def finish(self):
+        # Account for what is still running
+        control = self.control()
+        if control.running and control.method & (SimulatedLocation.METHOD_GNSS | SimulatedLocation.METHOD_AGNSS):
+            self.statistics.gps_seconds += self.clock.time() - control.started
+        connection = self.conic.connection
+        if connection.bearer is not None and connection.owned:
+            self.statistics.connected_seconds += self.clock.time() - connection.since
+
+    # Accessors
+    def connected(self):
+        return self.conic.connection.bearer is not None
+    def control(self):
+        return self.location.GPSDControl.get_default()
+
+    # Events
+    def onRecord(self, record):
+        kind = record["type"]
+        if kind == "gps":
+            # Only visible while someone is running the GPS
+            if self.control().satellites() or self.external:
+                self.device.deliver(record.get("mode", 3), record["lat"], record["lng"], record["acc"],
+                    record.get("alt", 0), record.get("head", 0), record.get("speed", 0))
+        elif kind == "cell":
+            self.cell = record
+            self.dbus.net.change()
+        elif kind == "scan":
+            self.scan = record
+        elif kind == "coverage":
+            self.coverage = record["available"]
+            if not self.coverage:
+                self.conic.connection.change(False, None)
+        elif kind == "service":
+            self.available = record["available"]
+        elif kind == "connection":
+            self.conic.connection.change(record["connected"], record.get("bearer", "GPRS"))
+        elif kind == "external":
+            self.external = record["running"]
+            if not self.external and not self.control().running:
+                self.device.lose()
+        elif kind == "device":
+            callback = self.osso.state.callback
+            if callback is not None:
+                callback(record.get("shutdown", False), record.get("save_unsaved_data", False),
+                         record.get("memory_low", False), record.get("system_inactivity", False), kind)
+        else:
+            self.logger.warning("Unknown trace record type %s" % kind)
+        return False
+
+def load(filename):
+    records = []
+    for line in open(filename):
+        line = line.strip()
+        if line:
+            records.append(json.loads(line))
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+#
+# Application handling
+#
+
+def main(args, extra):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(levelname)-10s %(name)s: %(message)s')
+
+    # Don't touch the state of a real installation
+    records = load(args.trace)
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix='latitude-'))
+
+    backend = SimulatedBackend(records)
+    latitude.init(latitude.parser.parse_args(extra), backend)
+    duration = args.duration or backend.duration
+    backend.clock.run(START + duration)
+    backend.finish()
+
+    print backend.statistics.report(duration)
+
+
+parser = argparse.ArgumentParser(description='Replay a trace against simulated hardware.',
+                                 epilog='Other arguments are passed on to the updater.')
+parser.add_argument('trace', help='the trace to replay')
+parser.add_argument('--duration', help='how long to simulate (seconds, defaults to the trace length)', type=float)
+parser.add_argument('--workdir', help='where to keep the state of the updater (defaults to a new directory)')
+parser.add_argument('--verbose', '-v', help='print more information', action='store_true')
+
+if __name__ == '__main__':
+    args, extra = parser.parse_known_args()
+    main(args, extra)